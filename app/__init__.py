@@ -81,6 +81,7 @@ from app import (
     cached_items,
     errors,
     models,
+    query_stats,
     routes,
     tasks_attack,
     tasks_control,
@@ -0,0 +1,183 @@
+"""Answer keys of the rounds: everything an attack upload is validated and scored against, gathered in a single compact numpy file per round. A key holds the verification set of every defending team of the round and the teams every attacking team should attack. It is built when the matches of a round are generated and rebuilt when a defence changes, so that evaluating an attack only makes in-memory lookups."""
+
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+from app import app, db
+from app.datasets import (
+    dataset_path,
+    load_verification_set,
+    stored_dataset_path,
+    write_atomically,
+)
+from app.models import Match
+
+# stat of a missing verification file, for the defending teams that have not defended yet
+MISSING_FILE_STAT = (-1, -1, -1)
+
+
+class AnswerKey:
+    """Arrays of a round's answer key. The verification set of the defending team defender_ids[i] is held by capture_ids[defender_offsets[i]:defender_offsets[i + 1]], sorted, and labels at the same positions. The teams attacker_ids[i] should attack are target_ids[attacker_offsets[i]:attacker_offsets[i + 1]], sorted, in the matches match_ids at the same positions."""
+
+    def __init__(
+        self,
+        defender_ids: np.ndarray,
+        defender_offsets: np.ndarray,
+        capture_ids: np.ndarray,
+        labels: np.ndarray,
+        verif_stats: np.ndarray,
+        attacker_ids: np.ndarray,
+        attacker_offsets: np.ndarray,
+        target_ids: np.ndarray,
+        match_ids: np.ndarray,
+    ) -> None:
+        self.defender_ids = defender_ids
+        self.defender_offsets = defender_offsets
+        self.capture_ids = capture_ids
+        self.labels = labels
+        # the (inode, modification time, size) of each defending team's verification file when the key was built
+        self.verif_stats = verif_stats
+        self.attacker_ids = attacker_ids
+        self.attacker_offsets = attacker_offsets
+        self.target_ids = target_ids
+        self.match_ids = match_ids
+
+    def __repr__(self) -> str:
+        return "<AnswerKey of {} defenders and {} attackers>".format(
+            len(self.defender_ids), len(self.attacker_ids)
+        )
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return dict(vars(self))
+
+    def targets(self, attacker_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted ids of the teams the team attacker_id should attack and the id of the match against each of them"""
+        i = np.searchsorted(self.attacker_ids, attacker_id)
+        if i == len(self.attacker_ids) or self.attacker_ids[i] != attacker_id:
+            return self.target_ids[:0], self.match_ids[:0]
+        start, end = self.attacker_offsets[i], self.attacker_offsets[i + 1]
+        return self.target_ids[start:end], self.match_ids[start:end]
+
+    def verification_set(self, defender_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the sorted capture ids of the team defender_id's test set and the true label of each of them, empty arrays if the team is not defending in the round"""
+        i = np.searchsorted(self.defender_ids, defender_id)
+        if i == len(self.defender_ids) or self.defender_ids[i] != defender_id:
+            return self.capture_ids[:0], self.labels[:0]
+        start, end = self.defender_offsets[i], self.defender_offsets[i + 1]
+        return self.capture_ids[start:end], self.labels[start:end]
+
+    def is_stale(self) -> bool:
+        """Returns whether a defending team's verification file changed since the key was built"""
+        return any(
+            verification_file_stat(defender_id) != tuple(stat)
+            for defender_id, stat in zip(
+                self.defender_ids.tolist(), self.verif_stats.tolist()
+            )
+        )
+
+
+def verification_file_stat(team_id: int) -> tuple[int, int, int]:
+    """Returns the (inode, modification time, size) of a team's verification file, MISSING_FILE_STAT if the team has no verification set"""
+    try:
+        stat = os.stat(stored_dataset_path("verif", team_id))
+    except FileNotFoundError:
+        return MISSING_FILE_STAT
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def offsets(sizes: list[int]) -> np.ndarray:
+    """Returns the bounds of consecutive segments of the given sizes"""
+    return np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+
+
+def build_answer_key(round: int) -> AnswerKey:
+    """Builds the answer key of a round from its matches and the current verification sets of the defending teams, and saves it to the upload folder.
+
+    Args:
+        round: the round of the matches
+
+    Returns:
+        answer_key: the built key
+    """
+    matches = np.array(
+        db.session.query(Match.attacker_team_id, Match.defender_team_id, Match.id)
+        .filter(Match.round == round)
+        .order_by(Match.attacker_team_id, Match.defender_team_id)
+        .all(),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    attacker_ids, attacker_sizes = np.unique(matches[:, 0], return_counts=True)
+    defender_ids = np.unique(matches[:, 1])
+    verif_stats, capture_ids, labels = [], [], []
+    for defender_id in defender_ids.tolist():
+        # the stat is taken first: a defence replacing the file meanwhile makes the key stale instead of wrongly fresh
+        stat = verification_file_stat(defender_id)
+        verif_stats.append(stat)
+        if stat == MISSING_FILE_STAT:
+            capture_ids.append(np.empty(0, dtype=np.int32))
+            labels.append(np.empty(0, dtype=np.int16))
+        else:
+            defender_capture_ids, defender_labels = load_verification_set(defender_id)
+            capture_ids.append(defender_capture_ids)
+            labels.append(defender_labels)
+    answer_key = AnswerKey(
+        defender_ids=defender_ids,
+        defender_offsets=offsets([len(ids) for ids in capture_ids]),
+        capture_ids=np.concatenate(capture_ids or [np.empty(0, dtype=np.int32)]),
+        labels=np.concatenate(labels or [np.empty(0, dtype=np.int16)]),
+        verif_stats=np.array(verif_stats, dtype=np.int64).reshape(-1, 3),
+        attacker_ids=attacker_ids,
+        attacker_offsets=offsets(attacker_sizes),
+        target_ids=matches[:, 1],
+        match_ids=matches[:, 2],
+    )
+
+    def write(path: str) -> None:
+        # np.savez would append the .npz extension to the temporary path
+        with open(path, "wb") as file:
+            np.savez(file, **answer_key.arrays())
+
+    write_atomically(write, dataset_path("ANSWER_KEY_FILENAME_FORMAT", round))
+    return answer_key
+
+
+def refresh_answer_key(round: int) -> Optional[AnswerKey]:
+    """Rebuilds the answer key of a round if its matches are generated, after a defence changed a verification set"""
+    if db.session.query(Match.id).filter(Match.round == round).first() is None:
+        return None
+    return build_answer_key(round)
+
+
+# a worker only evaluates the attacks of the current round, a few keys are enough
+@lru_cache(maxsize=4)
+def _load_answer_key(path: str, inode: int, mtime_ns: int, size: int) -> AnswerKey:
+    """Cached reading of an answer key file. The file's inode, modification time and size are only part of the cache key: a rebuilt key replaces the file and misses the cache."""
+    with np.load(path) as arrays:
+        answer_key = AnswerKey(**{name: arrays[name] for name in arrays.files})
+    # the arrays are shared by all the callers, none of them should modify them
+    for array in answer_key.arrays().values():
+        array.setflags(write=False)
+    return answer_key
+
+
+def load_answer_key(round: int) -> AnswerKey:
+    """Loads the answer key of a round, from a process local cache when it was already read since it was built. The key is built if it does not exist yet or if a verification set changed since it was built.
+
+    Args:
+        round: the round of the matches
+
+    Returns:
+        answer_key: the answer key of the round
+    """
+    path = dataset_path("ANSWER_KEY_FILENAME_FORMAT", round)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return build_answer_key(round)
+    answer_key = _load_answer_key(path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if answer_key.is_stale():
+        return build_answer_key(round)
+    return answer_key
@@ -0,0 +1,357 @@
+"""Bundles of the sets the attacking teams download: for a team and a round, a zip archive of the test and train sets of the teams it attacks. A bundle is built once for each version of these sets, in the background when the matches of the round are generated or a defence changes, then served straight from disk. It is named by the hash of its members' content and never modified. Until it is built, the same bytes are streamed from the member sets by a StoredZip."""
+
+import contextlib
+import glob
+import json
+import os
+import re
+import struct
+import time
+import zlib
+from functools import lru_cache
+from hashlib import sha256
+from typing import Iterator, Optional, Union
+
+from app import app, db
+from app.datasets import dataset_path, write_atomically
+from app.models import Match
+
+# the length of the version hashes in the bundle filenames
+VERSION_LENGTH = 16
+VERSION_REGEX = re.compile("[0-9a-f]{{{}}}".format(VERSION_LENGTH))
+# the size of the blocks the member files are read by
+BLOCK_SIZE = 1 << 20
+# the members of the stored zips are dated 1980-01-01 00:00, the earliest date of the zip format: an archive only depends on the names and content of its members
+ZIP_TIME, ZIP_DATE = 0, (1 << 5) | 1
+# the sizes and offsets of the zip format without its zip64 extension
+ZIP_LIMIT = 0xFFFFFFFF
+
+
+def bundle_targets(attacker_id: int, round: int) -> list[int]:
+    """Returns the sorted ids of the teams the team attacker_id attacks in the round"""
+    return [
+        defender_id
+        for defender_id, in db.session.query(Match.defender_team_id)
+        .filter(Match.round == round, Match.attacker_team_id == attacker_id)
+        .order_by(Match.defender_team_id)
+        .distinct()
+    ]
+
+
+def bundle_members(target_ids: list[int]) -> list[tuple[str, str]]:
+    """Returns the name in the bundle and the path of the test then train sets of the attacked teams, then of their feature matrices"""
+    paths = [dataset_path("TEST_FILENAME_FORMAT", id) for id in target_ids] + [
+        dataset_path("TRAIN_FILENAME_FORMAT", id) for id in target_ids
+    ]
+    # the defences uploaded before the feature matrices existed have none
+    paths += [
+        path
+        for path in [dataset_path("FEATURES_FILENAME_FORMAT", id) for id in target_ids]
+        if os.path.exists(path)
+    ]
+    return [(os.path.basename(path), path) for path in paths]
+
+
+@lru_cache(maxsize=256)
+def _member_checksums(
+    path: str, inode: int, mtime_ns: int, size: int
+) -> tuple[str, int]:
+    """Cached hashing of a set. The file's inode, modification time and size are only part of the cache key: a new defence replaces the file and misses the cache."""
+    hash, crc = sha256(), 0
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            hash.update(block)
+            crc = zlib.crc32(block, crc)
+    return hash.hexdigest(), crc
+
+
+def member_checksums(path: str) -> tuple[str, int]:
+    """Returns the sha256 digest and the CRC-32 of a set, computed once per process and version of the set.
+
+    Raises:
+        FileNotFoundError: if the set does not exist, when its team has not defended yet"""
+    stat = os.stat(path)
+    return _member_checksums(path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def bundle_version(digests: list[tuple[str, str]]) -> str:
+    """Returns the hash identifying the content of a bundle, from the names and sha256 digests of its members"""
+    hash = sha256()
+    for arcname, digest in digests:
+        hash.update("{} {}\n".format(arcname, digest).encode())
+    return hash.hexdigest()[:VERSION_LENGTH]
+
+
+class MemberFile:
+    """A member of a StoredZip, read from its file when the archive is. The file must not change meanwhile."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.crc = _member_checksums(path, *self.stat)[1]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def read(self, start: int, end: int) -> Iterator[bytes]:
+        """Yields the bytes of the file from start to end, by blocks.
+
+        Raises:
+            RuntimeError: if the file was replaced since the archive was laid out"""
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.stat:
+                raise RuntimeError("{} changed while being sent".format(self.path))
+            file.seek(start)
+            while start < end:
+                block = file.read(min(BLOCK_SIZE, end - start))
+                if not block:
+                    raise RuntimeError("{} is truncated".format(self.path))
+                start += len(block)
+                yield block
+
+
+class StoredZip:
+    """Zip archive of files stored without compression, laid out before any of its bytes is produced: its size is known and any range of its bytes is read straight from the member files, without writing the archive anywhere. Its bytes only depend on the names, content and order of its members."""
+
+    def __init__(self, members: list[tuple[str, str]]) -> None:
+        """Lays out the archive of the files at the paths of members, under their names in members.
+
+        Raises:
+            FileNotFoundError: if a member does not exist
+            ValueError: if the archive would need the zip64 extension"""
+        # the archive is the concatenation of its parts: the headers as bytes and the members' content as MemberFile
+        self.parts: list[Union[bytes, MemberFile]] = []
+        self.members: list[MemberFile] = []
+        central_directory = []
+        offset = 0
+        for arcname, path in members:
+            member = MemberFile(path)
+            name = arcname.encode()
+            if member.size > ZIP_LIMIT or offset > ZIP_LIMIT:
+                raise ValueError("The stored zip archives must be smaller than 4GB")
+            # version needed, flags, method, time, date, crc, compressed and uncompressed sizes, shared by the local and central headers
+            fields = struct.pack(
+                "<HHHHHIII",
+                20,
+                0,
+                0,
+                ZIP_TIME,
+                ZIP_DATE,
+                member.crc,
+                member.size,
+                member.size,
+            )
+            local_header = (
+                struct.pack("<I", 0x04034B50)
+                + fields
+                + struct.pack("<HH", len(name), 0)
+                + name
+            )
+            central_directory.append(
+                # made by unix zip 2.0, with rw-r--r-- permissions
+                struct.pack("<IH", 0x02014B50, 0x0314)
+                + fields
+                + struct.pack("<HHHHHII", len(name), 0, 0, 0, 0, 0o100644 << 16, offset)
+                + name
+            )
+            self.parts += [local_header, member]
+            self.members.append(member)
+            offset += len(local_header) + member.size
+        central_directory = b"".join(central_directory)
+        if offset + len(central_directory) > ZIP_LIMIT or len(members) > 0xFFFF:
+            raise ValueError("The stored zip archives must be smaller than 4GB")
+        end_record = struct.pack(
+            "<IHHHHIIH",
+            0x06054B50,
+            0,
+            0,
+            len(members),
+            len(members),
+            len(central_directory),
+            offset,
+            0,
+        )
+        self.parts += [central_directory, end_record]
+        self.size = offset + len(central_directory) + len(end_record)
+
+    def iter_bytes(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the bytes of the archive from start to end excluded, by blocks"""
+        end = self.size if end is None else end
+        part_start = 0
+        for part in self.parts:
+            part_end = part_start + len(part)
+            if part_start < end and start < part_end:
+                begin, stop = max(start, part_start), min(end, part_end)
+                if isinstance(part, bytes):
+                    yield part[begin - part_start : stop - part_start]
+                else:
+                    yield from part.read(begin - part_start, stop - part_start)
+            part_start = part_end
+
+    def write(self, path: str) -> None:
+        """Writes the archive to a file at path, atomically"""
+
+        def write(temp_path: str) -> None:
+            with open(temp_path, "wb") as file:
+                for block in self.iter_bytes():
+                    file.write(block)
+
+        write_atomically(write, path)
+
+
+def bundle_path(attacker_id: int, round: int, version: str) -> str:
+    """Returns the path in the upload folder of a version of a team's bundle, version being * for the pattern of all of them"""
+    return os.path.join(
+        app.root_path,
+        app.config["UPLOAD_FOLDER"],
+        app.config["BUNDLE_FILENAME_FORMAT"].format(attacker_id, round, version),
+    )
+
+
+def manifest_path(attacker_id: int, round: int, version: str) -> str:
+    """Returns the path in the upload folder of the manifest of a version of a team's bundle"""
+    return os.path.join(
+        app.root_path,
+        app.config["UPLOAD_FOLDER"],
+        app.config["MANIFEST_FILENAME_FORMAT"].format(attacker_id, round, version),
+    )
+
+
+class Bundle:
+    """The current version of a team's bundle: its version hash, its path, the manifest of its members and its archive to stream until it is built"""
+
+    def __init__(
+        self, attacker_id: int, round: int, members: list[tuple[str, str]]
+    ) -> None:
+        self.attacker_id = attacker_id
+        self.round = round
+        self.members = members
+        self.digests = [
+            (arcname, member_checksums(path)[0]) for arcname, path in members
+        ]
+        self.version = bundle_version(self.digests)
+        self.path = bundle_path(attacker_id, round, self.version)
+        self.zip = StoredZip(members)
+
+    def __repr__(self) -> str:
+        return "<Bundle {}>".format(os.path.basename(self.path))
+
+    def is_built(self) -> bool:
+        return os.path.exists(self.path)
+
+    def manifest(self) -> dict:
+        """Returns the manifest of the bundle: its version and the name, size and sha256 digest of each of its members"""
+        return {
+            "round": self.round,
+            "version": self.version,
+            "files": [
+                {"name": arcname, "size": member.size, "sha256": digest}
+                for (arcname, digest), member in zip(self.digests, self.zip.members)
+            ],
+        }
+
+    def save_manifest(self) -> None:
+        """Saves the manifest of this version of the bundle, kept to send the members changed since it"""
+        path = manifest_path(self.attacker_id, self.round, self.version)
+        if os.path.exists(path):
+            return
+
+        def write(temp_path: str) -> None:
+            with open(temp_path, "w") as file:
+                json.dump(self.manifest(), file)
+
+        write_atomically(write, path)
+
+    def delta(self, previous_manifest: dict) -> StoredZip:
+        """Returns the archive of the members whose content changed since the version of previous_manifest, or that it did not hold"""
+        previous_digests = {
+            file["name"]: file["sha256"] for file in previous_manifest["files"]
+        }
+        return StoredZip(
+            [
+                (arcname, path)
+                for (arcname, path), (_, digest) in zip(self.members, self.digests)
+                if previous_digests.get(arcname) != digest
+            ]
+        )
+
+
+def load_manifest(attacker_id: int, round: int, version: str) -> Optional[dict]:
+    """Returns the saved manifest of a version of a team's bundle, None if the version is unknown"""
+    if not VERSION_REGEX.fullmatch(version):
+        return None
+    try:
+        with open(manifest_path(attacker_id, round, version)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def current_bundle(attacker_id: int, round: int) -> Optional[Bundle]:
+    """Returns the bundle of the current sets of the teams a team attacks in the round, built or not, None if the team has no match in the round. Its manifest is saved, for the downloads of the members changed since this version.
+
+    Raises:
+        FileNotFoundError: if an attacked team has not defended yet"""
+    members = bundle_members(bundle_targets(attacker_id, round))
+    if not members:
+        return None
+    bundle = Bundle(attacker_id, round, members)
+    bundle.save_manifest()
+    return bundle
+
+
+def build_bundle(attacker_id: int, round: int) -> Optional[str]:
+    """Builds the bundle of the current sets of the teams a team attacks in the round, unless it already exists, and removes its previous versions.
+
+    Args:
+        attacker_id: the id of the attacking team
+        round: the round of the matches
+
+    Returns:
+        path: the path of the bundle, None if the team has no match in the round
+
+    Raises:
+        FileNotFoundError: if an attacked team has not defended yet"""
+    # taken before the sets are read: the versions written since then may be newer than ours
+    started_ns = time.time_ns()
+    bundle = current_bundle(attacker_id, round)
+    if bundle is None:
+        return None
+    if bundle.is_built():
+        return bundle.path
+    # the built bundle holds the very bytes streamed until then
+    bundle.zip.write(bundle.path)
+    # the downloads of a previous version in progress keep their open file. Another builder may be removing the same versions
+    for stale_path in glob.glob(bundle_path(attacker_id, round, "*")):
+        with contextlib.suppress(FileNotFoundError):
+            if (
+                stale_path != bundle.path
+                and os.stat(stale_path).st_mtime_ns < started_ns
+            ):
+                os.remove(stale_path)
+    return bundle.path
+
+
+def build_round_bundles(round: int, defender_id: Optional[int] = None) -> int:
+    """Builds the bundles of the round that are missing or outdated, skipping the teams some attacked team of which has not defended yet.
+
+    Args:
+        round: the round of the matches
+        defender_id: if given, only the bundles of the teams attacking this team are built, after its defence changed
+
+    Returns:
+        nb_bundles: the number of bundles up to date"""
+    attackers = db.session.query(Match.attacker_team_id).filter(Match.round == round)
+    if defender_id is not None:
+        attackers = attackers.filter(Match.defender_team_id == defender_id)
+    nb_bundles = 0
+    for (attacker_id,) in attackers.distinct().all():
+        try:
+            nb_bundles += build_bundle(attacker_id, round) is not None
+        except FileNotFoundError:
+            # the bundle is built with the defence of the last attacked team
+            continue
+    return nb_bundles
@@ -1,10 +1,142 @@
-"""Stores a cached version of displayed items with the last update time. Can be accessed by the rest of the application as a global instance"""
+"""Stores a cached version of displayed items with the last update time. Can be accessed by the rest of the application as a global instance. The leaderboard items are shared by all the processes through Redis, each process only keeps its own copy when Redis is unreachable."""
 
+import json
 import time
+import uuid
+from typing import Callable, Optional
+
+import redis
+
+from app import app
+
+LEADERBOARD_CACHE_TIME = app.config["LEADERBOARD_CACHE_TIME"]
+LEADERBOARD_LOCK_TIME = app.config["LEADERBOARD_LOCK_TIME"]
+LEADERBOARD_WAIT_TIME = app.config["LEADERBOARD_WAIT_TIME"]
+# in seconds, interval at which a process waits for another one computing the first leaderboard
+LEADERBOARD_POLL_TIME = 0.05
+
+# deletes the lock only if it is still ours, the one of a slow process may have expired and been taken by another one meanwhile
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# stores the items, and marks them fresh only if no invalidation happened since their computation started
+STORE_ITEMS_SCRIPT = """
+redis.call('set', KEYS[1], ARGV[1])
+if redis.call('incrby', KEYS[2], 0) == tonumber(ARGV[2]) then
+    redis.call('set', KEYS[3], 1, 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
 
 
 class CachedLeaderboard:
-    """Object holding the last update of the leaderboard and the leaderboard items received in the leaderboard.html template"""
+    """Object holding the last update of the leaderboard and the leaderboard items received in the leaderboard.html template. The items of a round are stored in Redis along with a key marking them fresh for LEADERBOARD_CACHE_TIME seconds. Once they are stale, a single process recomputes them while holding a lock, the other processes keep serving the stale items meanwhile. The upload tasks mark the items stale when they commit new scores, by incrementing a generation counter: items whose computation started before an invalidation are never marked fresh."""
 
+    # process local copy of the items, only used when Redis is unreachable
     last_update: float = time.time()
     leaderboard: dict = None
+    redis_client: Optional[redis.Redis] = None
+
+    @staticmethod
+    def client() -> redis.Redis:
+        """Returns the client of the Redis instance sharing the leaderboard, created on first use"""
+        if CachedLeaderboard.redis_client is None:
+            # short timeouts: an unreachable Redis must not slow the page down
+            CachedLeaderboard.redis_client = redis.Redis.from_url(
+                app.config["LEADERBOARD_REDIS_URL"],
+                socket_timeout=0.5,
+                socket_connect_timeout=0.5,
+            )
+        return CachedLeaderboard.redis_client
+
+    @staticmethod
+    def key(round: int, name: str) -> str:
+        return "leaderboard:{}:{}".format(round, name)
+
+    @staticmethod
+    def get(round: int, compute: Callable[[], list[dict]]) -> Optional[list[dict]]:
+        """Returns the leaderboard items of the round, recomputed with compute if they are stale and no other process is recomputing them.
+
+        Args:
+            round: the round of the leaderboard
+            compute: the function computing the items from the database
+
+        Returns:
+            team_items: the leaderboard items, None if another process has been computing the first items for more than LEADERBOARD_WAIT_TIME seconds
+        """
+        try:
+            return CachedLeaderboard.get_shared(round, compute)
+        except redis.RedisError:
+            return CachedLeaderboard.get_local(compute)
+
+    @staticmethod
+    def get_shared(
+        round: int, compute: Callable[[], list[dict]]
+    ) -> Optional[list[dict]]:
+        """Returns the leaderboard items stored in Redis, recomputing them in a single process at once when they are stale"""
+        client = CachedLeaderboard.client()
+        items_key = CachedLeaderboard.key(round, "items")
+        fresh_key = CachedLeaderboard.key(round, "fresh")
+        lock_key = CachedLeaderboard.key(round, "lock")
+        generation_key = CachedLeaderboard.key(round, "generation")
+        deadline = time.time() + LEADERBOARD_WAIT_TIME
+        while True:
+            items, fresh = client.mget(items_key, fresh_key)
+            if items is not None and fresh is not None:
+                return json.loads(items)
+            # the token makes sure we only release our own lock
+            token = uuid.uuid4().hex
+            if client.set(lock_key, token, nx=True, ex=LEADERBOARD_LOCK_TIME):
+                try:
+                    # read before computing: an invalidation landing during the computation changes it
+                    generation = client.incrby(generation_key, 0)
+                    team_items = compute()
+                    client.eval(
+                        STORE_ITEMS_SCRIPT,
+                        3,
+                        items_key,
+                        generation_key,
+                        fresh_key,
+                        json.dumps(team_items),
+                        generation,
+                        LEADERBOARD_CACHE_TIME,
+                    )
+                finally:
+                    client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+                return team_items
+            if items is not None:
+                # another process is recomputing, the stale items are served meanwhile
+                return json.loads(items)
+            if time.time() > deadline:
+                # computing here too would pile up the computations the lock avoids, and the user already waited
+                return None
+            # nothing to serve yet, we wait for the process computing the first items
+            time.sleep(LEADERBOARD_POLL_TIME)
+
+    @staticmethod
+    def get_local(compute: Callable[[], list[dict]]) -> list[dict]:
+        """Returns the leaderboard items cached by this process, recomputing them every LEADERBOARD_CACHE_TIME seconds"""
+        if (
+            CachedLeaderboard.leaderboard is None
+            or time.time() - CachedLeaderboard.last_update > LEADERBOARD_CACHE_TIME
+        ):
+            CachedLeaderboard.leaderboard = compute()
+            CachedLeaderboard.last_update = time.time()
+        return CachedLeaderboard.leaderboard
+
+    @staticmethod
+    def invalidate(round: int) -> None:
+        """Marks the leaderboard items of the round stale, the next request recomputes them. Called once new scores are committed."""
+        CachedLeaderboard.leaderboard = None
+        try:
+            client = CachedLeaderboard.client()
+            # the generation is changed first, a computation in progress then cannot mark its items fresh
+            client.incr(CachedLeaderboard.key(round, "generation"))
+            client.delete(CachedLeaderboard.key(round, "fresh"))
+        except redis.RedisError:
+            # the items of the other processes will expire with their cache time
+            pass
@@ -0,0 +1,295 @@
+"""Reading of the uploaded files, saving and loading of the datasets produced from the defence uploads. Each set is saved as a compressed csv file given to the students and, when pyarrow is installed, as a typed Arrow file that the server reads by preference."""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from hashlib import sha256
+from typing import BinaryIO, Callable, Iterator, Optional, Union
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Index
+
+from app import app
+
+# pyarrow is optional, without it the csv files are the only artifacts and are parsed by pandas
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import feather
+except ImportError:
+    pa = None
+    pa_csv = None
+    feather = None
+
+CLASS_NAME = app.config["DEFENCE_COLUMNS"][0]
+CAPTURE_NAME = app.config["ATTACK_COLUMNS"][1]
+
+# explicit compact types of the columns of the uploaded and produced csv files, instead of the 64 bits types pandas infers
+CSV_DTYPES = {
+    CLASS_NAME: np.int16,
+    app.config["DEFENCE_COLUMNS"][1]: np.int32,  # rep
+    "direction_size": np.int32,
+    "timestamp": np.float32,
+    app.config["ATTACK_COLUMNS"][0]: np.int32,  # team_id
+    CAPTURE_NAME: np.int32,
+}
+# the probabilities keep 64 bits: their sum is checked against a 10^-10 tolerance and they are ranked for the roc_auc_score
+CSV_DTYPES.update(
+    {
+        col: np.float64
+        for col in app.config["ATTACK_COLUMNS"]
+        if col.startswith(app.config["PROBA_CLASS_PREFIX"])
+    }
+)
+
+# the umask can only be read by setting it, we read it once when the module is imported
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# config keys of the csv and Arrow filename formats for each kind of dataset
+DATASET_FILENAME_FORMATS = {
+    "test": ("TEST_FILENAME_FORMAT", "TEST_ARROW_FILENAME_FORMAT"),
+    "verif": ("VERIF_FILENAME_FORMAT", "VERIF_ARROW_FILENAME_FORMAT"),
+    "train": ("TRAIN_FILENAME_FORMAT", "TRAIN_ARROW_FILENAME_FORMAT"),
+}
+
+
+def enforce_schema(df: DataFrame) -> DataFrame:
+    """Casts in place the columns of df to their type in CSV_DTYPES and returns df.
+
+    Raises:
+        ValueError: if a column holds values that do not fit its type, like decimal or missing values in an integer column
+    """
+    for column, dtype in CSV_DTYPES.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        values = df[column]
+        if np.issubdtype(dtype, np.integer):
+            if not np.issubdtype(values.dtype, np.integer):
+                raise ValueError(
+                    "Column {} should only contain integers".format(column)
+                )
+            bounds = np.iinfo(dtype)
+            if len(values) and (values.min() < bounds.min or values.max() > bounds.max):
+                raise ValueError(
+                    "Column {} holds integers out of [{}, {}]".format(
+                        column, bounds.min, bounds.max
+                    )
+                )
+        df[column] = values.astype(dtype)
+    return df
+
+
+def zip_member(zip: ZipFile) -> str:
+    """Returns the name of the single file of a zip archive, its directories left aside
+
+    Raises:
+        ValueError: if the archive holds no file or several"""
+    names = [name for name in zip.namelist() if not name.endswith("/")]
+    if not names:
+        raise ValueError("Zero files found in ZIP file {}".format(zip.filename))
+    if len(names) > 1:
+        raise ValueError(
+            "Multiple files found in ZIP file. Only one file per ZIP: {}".format(names)
+        )
+    return names[0]
+
+
+@contextmanager
+def open_csv(filepath: str) -> Iterator[Union[str, BinaryIO]]:
+    """Gives what the csv parsers read a (compressed) csv file from: the single file of a zip archive, opened here whichever parser reads it, or the path of another file
+
+    Raises:
+        ValueError: if a zip archive holds no file or several"""
+    if not filepath.endswith(".zip"):
+        yield filepath
+        return
+    # the uploads and produced sets are zip archives holding a single csv file
+    with ZipFile(filepath) as zip, zip.open(zip_member(zip)) as file:
+        yield file
+
+
+def read_csv_header(filepath: str) -> Index:
+    """Returns the column names of a (compressed) csv file without reading its content"""
+    with open_csv(filepath) as file:
+        return pd.read_csv(file, nrows=0).columns
+
+
+def read_csv(filepath: str, columns: Optional[list[str]] = None) -> DataFrame:
+    """Reads a (compressed) csv file with the columns typed as in CSV_DTYPES. Parsed by the multithreaded pyarrow reader when it is installed, which types the columns while parsing.
+
+    Args:
+        filepath: the path to the csv file, optionally zipped
+        columns: the columns to read, all of them if None
+
+    Returns:
+        df: the content of the file
+
+    Raises:
+        ValueError: if a column holds values that do not fit its type"""
+    if pa_csv is None:
+        with open_csv(filepath) as file:
+            return enforce_schema(pd.read_csv(file, usecols=columns))
+    convert_options = pa_csv.ConvertOptions(
+        column_types={
+            column: pa.from_numpy_dtype(dtype) for column, dtype in CSV_DTYPES.items()
+        },
+        include_columns=columns,
+    )
+    with open_csv(filepath) as file:
+        table = pa_csv.read_csv(file, convert_options=convert_options)
+    # missing values in integer columns are converted to floats by pyarrow, the schema enforcement rejects them
+    return enforce_schema(table.to_pandas())
+
+
+def read_csv_chunks(filepath: str, chunksize: int) -> Iterator[DataFrame]:
+    """Reads a (compressed) csv file by chunks of chunksize rows, each typed as in CSV_DTYPES. Only one chunk is held in memory at once.
+
+    Raises:
+        ValueError: if a column holds values that do not fit its type"""
+    with open_csv(filepath) as file, pd.read_csv(file, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield enforce_schema(chunk)
+
+
+def file_digest(fileobj: BinaryIO, block_size: int = 1 << 20) -> str:
+    """Returns the hexadecimal sha256 digest of the content of a binary file object, read by blocks from its current position"""
+    hash = sha256()
+    for block in iter(lambda: fileobj.read(block_size), b""):
+        hash.update(block)
+    return hash.hexdigest()
+
+
+def dataset_path(filename_format: str, team_id: int) -> str:
+    """Returns the path in the upload folder of the file named by the config key filename_format for the team"""
+    return os.path.join(
+        app.root_path,
+        app.config["UPLOAD_FOLDER"],
+        app.config[filename_format].format(team_id),
+    )
+
+
+def write_atomically(write: Callable[[str], None], path: str) -> None:
+    """Writes with write to a temporary file then renames it to path, so that readers never see a partially written file"""
+    # a unique temporary file, processes writing the same file concurrently do not mix their content
+    fd, temp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path)
+    )
+    os.close(fd)
+    try:
+        write(temp_path)
+        # mkstemp creates the file readable by its owner only, we give it the mode open would
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def save_dataset(df: DataFrame, kind: str, team_id: int) -> None:
+    """Saves one of the sets produced from a team's defence.
+
+    Args:
+        df: the dataset to save
+        kind: one of 'test', 'verif' or 'train'
+        team_id: the id of the defending team
+    """
+    csv_format, arrow_format = DATASET_FILENAME_FORMATS[kind]
+    arrow_path = dataset_path(arrow_format, team_id)
+    if feather is not None:
+        # we must take care of removing the indexes in case this could reveal the split
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        write_atomically(lambda path: feather.write_feather(table, path), arrow_path)
+    elif os.path.exists(arrow_path):
+        # an Arrow file from a previous defence would be read instead of the new csv
+        os.remove(arrow_path)
+    csv_path = dataset_path(csv_format, team_id)
+    write_atomically(
+        lambda path: df.to_csv(
+            path,
+            index=False,
+            compression={
+                "method": "zip",
+                "archive_name": os.path.basename(csv_path)[: -len(".zip")],
+            },
+        ),
+        csv_path,
+    )
+
+
+def save_features(features: dict[str, np.ndarray], team_id: int) -> None:
+    """Saves the padded feature matrices of a team's test and train sets, built by tasks_defence.feature_matrices, as a compressed numpy file given to the students with the sets"""
+
+    def write(path: str) -> None:
+        # np.savez_compressed would append the .npz extension to the temporary path
+        with open(path, "wb") as file:
+            np.savez_compressed(file, **features)
+
+    write_atomically(write, dataset_path("FEATURES_FILENAME_FORMAT", team_id))
+
+
+def stored_dataset_path(kind: str, team_id: int) -> str:
+    """Returns the path of the file a set is loaded from: its Arrow file if there is one, its csv file otherwise"""
+    csv_format, arrow_format = DATASET_FILENAME_FORMATS[kind]
+    if feather is not None:
+        arrow_path = dataset_path(arrow_format, team_id)
+        if os.path.exists(arrow_path):
+            return arrow_path
+    return dataset_path(csv_format, team_id)
+
+
+def _read_dataset(path: str, columns: Optional[list[str]] = None) -> DataFrame:
+    """Reads a set from its Arrow or csv file"""
+    if path.endswith(".arrow"):
+        # memory mapping avoids copying the file in memory before decoding it, and only the requested columns are decoded
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return read_csv(path, columns=columns)
+
+
+def load_dataset(
+    kind: str, team_id: int, columns: Optional[list[str]] = None
+) -> DataFrame:
+    """Loads one of the sets produced from a team's defence, from its Arrow file if there is one, from its csv file otherwise.
+
+    Args:
+        kind: one of 'test', 'verif' or 'train'
+        team_id: the id of the defending team
+        columns: the columns to read, all of them if None
+
+    Returns:
+        df: the loaded dataset
+    """
+    return _read_dataset(stored_dataset_path(kind, team_id), columns=columns)
+
+
+@lru_cache(maxsize=app.config["VERIFICATION_CACHE_SIZE"])
+def _load_verification_set(
+    path: str, inode: int, mtime_ns: int, size: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Cached reading of a verification set. The file's inode, modification time and size are only part of the cache key: a new defence replaces the file and misses the cache."""
+    df = _read_dataset(path, columns=[CAPTURE_NAME, CLASS_NAME])
+    order = np.argsort(df[CAPTURE_NAME].to_numpy(), kind="stable")
+    capture_ids = df[CAPTURE_NAME].to_numpy()[order]
+    labels = df[CLASS_NAME].to_numpy()[order]
+    # the arrays are shared by all the callers, none of them should modify them
+    capture_ids.setflags(write=False)
+    labels.setflags(write=False)
+    return capture_ids, labels
+
+
+def load_verification_set(team_id: int) -> tuple[np.ndarray, np.ndarray]:
+    """Loads a team's verification set, from a process local cache when it was already read since the team's last defence.
+
+    Args:
+        team_id: the id of the defending team
+
+    Returns:
+        capture_ids: the read-only sorted array of the capture ids of the team's test set
+        labels: the read-only array of the true label of each capture in capture_ids
+    """
+    path = stored_dataset_path("verif", team_id)
+    stat = os.stat(path)
+    return _load_verification_set(path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,134 @@
+"""Generation of the matches of a round. The participating teams are placed on a circle and every team attacks the teams at a few fixed offsets after it: each team then attacks and is attacked by exactly MATCHES_PER_TEAM teams. The circle keeps the same order from round to round, so that choosing offsets unused by the previous rounds never repeats an attacker-defender pair. Random orders are tried as well when it cannot be avoided. The order is not secret: the matches of the first round, listed to every user, reveal it."""
+
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import insert, or_
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from app.models import Match, Team, User
+
+
+def participating_team_ids() -> np.ndarray:
+    """Returns the ids of the teams without an admin member, with a single query"""
+    member1, member2 = aliased(User), aliased(User)
+    team_ids = (
+        db.session.query(Team.id)
+        .outerjoin(member1, member1.id == Team.member1_id)
+        .outerjoin(member2, member2.id == Team.member2_id)
+        .filter(
+            or_(member1.is_admin.is_(None), member1.is_admin.is_(False)),
+            or_(member2.is_admin.is_(None), member2.is_admin.is_(False)),
+        )
+        .all()
+    )
+    return np.array([team_id for team_id, in team_ids], dtype=np.int64)
+
+
+def previous_pairs(round: int) -> np.ndarray:
+    """Returns the (n_matches, 2) array of the attacker and defender team ids of the matches of the rounds before round"""
+    pairs = (
+        db.session.query(Match.attacker_team_id, Match.defender_team_id)
+        .filter(Match.round < round)
+        .all()
+    )
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def circle_order(team_ids: np.ndarray, seed: int) -> np.ndarray:
+    """Returns the team ids sorted by a seeded hash of their id: an order unrelated to the order of registration, in which the teams keep their relative positions when teams join or leave"""
+    x = team_ids.astype(np.uint64) ^ np.uint64(seed)
+    # the splitmix64 finalizer, the products overflow on purpose
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return team_ids[np.argsort(x, kind="stable")]
+
+
+def pair_teams(
+    team_ids: np.ndarray,
+    matches_per_team: int,
+    past_pairs: np.ndarray,
+    nb_shuffles: int,
+    rng: Optional[np.random.Generator] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """Pairs the teams for a round: on a circle of the teams, each team attacks the teams at matches_per_team distinct offsets after it. Every team attacks matches_per_team other teams and is attacked as many times, never by itself and never twice by the same team. The offsets repeating the fewest pairs of past_pairs are chosen, on the circle of circle_order(team_ids, seed) or, if they repeat some, on the best of nb_shuffles random circles.
+
+    Args:
+        team_ids: the ids of the participating teams
+        matches_per_team: the number of teams each team attacks, at most len(team_ids) - 1
+        past_pairs: the (n_matches, 2) array of the attacker and defender team ids of the previous matches
+        nb_shuffles: the number of random orders tried when the order of the seed repeats pairs
+        rng: the random generator, a fresh one if None
+        seed: the seed of the order of the circle kept from round to round
+
+    Returns:
+        pairs: the (len(team_ids) * matches_per_team, 2) array of the attacker and defender team ids of the matches
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    nb_teams = len(team_ids)
+    if nb_teams == 0 or matches_per_team <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+    # we only count the past pairs of two teams still participating
+    past_pairs = past_pairs[np.isin(past_pairs, team_ids).all(axis=1)]
+    positions = np.empty(team_ids.max() + 1, dtype=np.int64)
+    best = None
+    for attempt in range(nb_shuffles + 1):
+        order = (
+            circle_order(team_ids, seed) if attempt == 0 else rng.permutation(team_ids)
+        )
+        positions[order] = np.arange(nb_teams)
+        # a past pair is repeated by the offset from its attacker to its defender on the circle
+        past_offsets = (
+            positions[past_pairs[:, 1]] - positions[past_pairs[:, 0]]
+        ) % nb_teams
+        repeats = np.bincount(past_offsets, minlength=nb_teams)[1:]
+        # the offset 0 would match a team against itself
+        # the offsets repeating as many pairs are chosen at random
+        offsets = np.lexsort((rng.random(nb_teams - 1), repeats))[:matches_per_team] + 1
+        nb_repeats = repeats[offsets - 1].sum()
+        if best is None or nb_repeats < best[0]:
+            best = nb_repeats, order, offsets
+        if nb_repeats == 0:
+            break
+    _, order, offsets = best
+    attackers = np.repeat(np.arange(nb_teams), len(offsets))
+    defenders = (attackers + np.tile(offsets, nb_teams)) % nb_teams
+    return np.stack((order[attackers], order[defenders]), axis=1)
+
+
+def generate_round_matches(
+    round: int, rng: Optional[np.random.Generator] = None
+) -> int:
+    """Generates the matches of a round between the teams without an admin member and inserts them at once. Does not commit.
+
+    Args:
+        round: the round of the matches
+        rng: the random generator, a fresh one if None
+
+    Returns:
+        nb_matches: the number of generated matches
+    """
+    team_ids = participating_team_ids()
+    # we make sure not to have more than nb_teams-1 matches per team to avoid self-matching
+    matches_per_team = min(app.config["MATCHES_PER_TEAM"], len(team_ids) - 1)
+    pairs = pair_teams(
+        team_ids,
+        matches_per_team,
+        previous_pairs(round),
+        app.config["MATCHMAKING_SHUFFLES"],
+        rng,
+        app.config["MATCHMAKING_SEED"],
+    )
+    if len(pairs) == 0:
+        return 0
+    db.session.execute(
+        insert(Match),
+        [
+            {"attacker_team_id": attacker, "defender_team_id": defender, "round": round}
+            for attacker, defender in pairs.tolist()
+        ],
+    )
+    return len(pairs)
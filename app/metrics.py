@@ -0,0 +1,61 @@
+"""Metrics scoring the uploaded attacks. They are computed with numpy only, without the input validation of sklearn, which is then not imported by the web process."""
+
+import numpy as np
+
+
+def row_ranks(scores: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Ranks the scores of each row of a matrix in increasing order, from 1, tied scores sharing the mean of their ranks.
+
+    Args:
+        scores: the (n_rows, n_columns) matrix of scores
+
+    Returns:
+        order: the (n_rows, n_columns) matrix of the column indexes sorting each row
+        ranks: the (n_rows, n_columns) matrix of the rank of scores[i, order[i, j]] in its row i
+    """
+    nb_rows, nb_columns = scores.shape
+    order = np.argsort(scores, axis=1, kind="stable")
+    # we lay the sorted rows one after the other to find all the groups of tied scores at once
+    sorted_scores = np.take_along_axis(scores, order, axis=1).ravel()
+    group_starts = np.ones(sorted_scores.size, dtype=bool)
+    group_starts[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    # a group never spans two rows
+    group_starts[::nb_columns] = True
+    starts = np.flatnonzero(group_starts)
+    ends = np.append(starts[1:], sorted_scores.size)
+    # the ranks in a group are consecutive, their mean is the mean of the first and last one
+    mean_ranks = (starts % nb_columns + (ends - 1) % nb_columns) / 2 + 1
+    return order, np.repeat(mean_ranks, ends - starts).reshape(nb_rows, nb_columns)
+
+
+def one_vs_rest_roc_auc(
+    true_labels: np.ndarray, proba: np.ndarray, classes: np.ndarray
+) -> float:
+    """Computes the unweighted mean over the classes of the area under the ROC curve of each class against the others, as sklearn's roc_auc_score(true_labels, proba, multi_class="ovr", labels=classes). The area of a class is the Mann-Whitney U statistic of its column, normalized: the probability that a capture of the class is given a higher probability than a capture of another class, ties counting for a half.
+
+    Args:
+        true_labels: the true class of each capture
+        proba: the (n_captures, n_classes) matrix of the probability given to each class for each capture
+        classes: the class of each column of proba
+
+    Returns:
+        auc: the one-vs-rest ROC AUC
+
+    Raises:
+        ValueError: if a class has no capture or all the captures, its area is then undefined
+    """
+    # each class is ranked in a contiguous row of the transposed matrix, faster to sort than a column
+    order, ranks = row_ranks(np.ascontiguousarray(proba.T))
+    # positives[i, j] is whether the capture with the rank ranks[i, j] belongs to the class i
+    positives = true_labels[order] == classes[:, np.newaxis]
+    nb_positives = positives.sum(axis=1)
+    nb_negatives = len(true_labels) - nb_positives
+    if not (nb_positives.all() and nb_negatives.all()):
+        raise ValueError(
+            "Only one class present in y_true. ROC AUC score is not defined in that case."
+        )
+    rank_sums = np.where(positives, ranks, 0.0).sum(axis=1)
+    areas = (rank_sums - nb_positives * (nb_positives + 1) / 2) / (
+        nb_positives * nb_negatives
+    )
+    return float(areas.mean())
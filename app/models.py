@@ -1,17 +1,19 @@
 """Defines data model with SQLAlchemy ORM"""
 
 
+import time
 from datetime import datetime
-from math import log10
+from math import log10, nan
 from typing import Optional, Union
 
+from flask import g, has_request_context
 from flask_login import UserMixin
 from flask_sqlalchemy import Pagination
 from sqlalchemy import and_, func, or_
-from sqlalchemy.orm import Query
+from sqlalchemy.orm import Query, joinedload
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login
+from app import app, db, login
 
 
 class User(UserMixin, db.Model):
@@ -25,12 +27,18 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
 
     def team(self) -> Optional["Team"]:
-        """Gives the Team object this user is member of or None if they're in no team."""
-        return (
+        """Gives the Team object this user is member of or None if they're in no team. Looked up once per request."""
+        teams = request_teams()
+        if teams is not None and self.id in teams:
+            return teams[self.id]
+        team = (
             db.session.query(Team)
             .filter(or_(Team.member1_id == self.id, Team.member2_id == self.id))
             .first()
         )
+        if teams is not None:
+            teams[self.id] = team
+        return team
 
     def has_team(self) -> bool:
         """Returns whether this user is member of a team"""
@@ -49,10 +57,103 @@ class User(UserMixin, db.Model):
         return "<User {} (id: {})>".format(self.username, self.id)
 
 
+# the logged in users and their team kept by this process for IDENTITY_CACHE_TIME seconds, by user id
+cached_identities: dict[int, tuple[float, User, Optional["Team"]]] = {}
+
+
+def request_teams() -> Optional[dict[int, Optional["Team"]]]:
+    """Returns the teams of the users already looked up during the current request, by user id, None outside of a request"""
+    if not has_request_context():
+        return None
+    if "user_teams" not in g:
+        g.user_teams = {}
+    return g.user_teams
+
+
+def forget_identity(user_id: int) -> None:
+    """Drops the cached team of a user, to call when the user joins a team"""
+    cached_identities.pop(user_id, None)
+    teams = request_teams()
+    if teams is not None:
+        teams.pop(user_id, None)
+
+
 # Required by flask-login module
 @login.user_loader
-def load_user(id: int) -> User:
-    return User.query.get(int(id))
+def load_user(id: str) -> Optional[User]:
+    """Loads the logged in user and their team with a single query, or from the process cache when IDENTITY_CACHE_TIME is set"""
+    user_id = int(id)
+    expiry, user, team = cached_identities.get(user_id, (0, None, None))
+    if expiry > time.monotonic():
+        # we attach copies of the cached objects to the session without querying the database
+        user = db.session.merge(user, load=False)
+        team = db.session.merge(team, load=False) if team is not None else None
+    else:
+        row = (
+            db.session.query(User, Team)
+            .outerjoin(
+                Team, or_(Team.member1_id == User.id, Team.member2_id == User.id)
+            )
+            .filter(User.id == user_id)
+            .first()
+        )
+        if row is None:
+            return None
+        user, team = row
+        if app.config["IDENTITY_CACHE_TIME"] > 0:
+            cached_identities[user_id] = (
+                time.monotonic() + app.config["IDENTITY_CACHE_TIME"],
+                user,
+                team,
+            )
+    teams = request_teams()
+    if teams is not None:
+        teams[user_id] = team
+    return user
+
+
+# messages displayed instead of the scores not computable yet
+NO_DEFENCE_MESSAGE = "No defence uploaded yet"
+ATTACKS_REMAINING_MESSAGE = "Some attacks remain to do"
+NO_TOTAL_SCORE_MESSAGE = "Cannot compute full score yet"
+
+
+def utility_score_of(aggregated_score: Optional[float]) -> Union[float, str]:
+    """Returns either the utility score of the defence with this aggregated score, or the error message to be displayed if there is no defence"""
+    return aggregated_score if aggregated_score is not None else NO_DEFENCE_MESSAGE
+
+
+def attack_performance_of(
+    mean_result: Optional[float], completed_matches: int, nb_matches: int
+) -> Union[float, str]:
+    """Returns either the average aggregated result mean_result of the latest attack of each match if all the nb_matches matches were attacked, or the error message to be displayed"""
+    # we only give the average aggregated result when all matches are done
+    if completed_matches == nb_matches and completed_matches != 0:
+        return mean_result
+    return ATTACKS_REMAINING_MESSAGE
+
+
+def total_score_of(
+    util_score: Union[float, str], atk_perf: Union[float, str]
+) -> Union[float, str]:
+    """Returns either the total score from the utility and attack performance scores, or the error message to be displayed. The total score is the product of the utility and attack performance metrics. We can see it as (roc_auc_score)/(time_consumption*bandwidth_consumption). If not all attacks are done, the attack perf score is set to 1.0 (this should be less than a random classifier's performance with the current settings and for secretstroll application)"""
+    if isinstance(util_score, float):
+        return (atk_perf if isinstance(atk_perf, float) else 1.0) * util_score
+    else:
+        return NO_TOTAL_SCORE_MESSAGE
+
+
+def displayed_scores(
+    utility_score: Optional[float],
+    attack_performance: Optional[float],
+    total_score: Optional[float],
+) -> tuple[Union[float, str], Union[float, str], Union[float, str]]:
+    """Returns the stored scores of a team, with the error message to be displayed instead of the scores not computable yet (stored as None)"""
+    return (
+        NO_DEFENCE_MESSAGE if utility_score is None else utility_score,
+        ATTACKS_REMAINING_MESSAGE if attack_performance is None else attack_performance,
+        NO_TOTAL_SCORE_MESSAGE if total_score is None else total_score,
+    )
 
 
 class Team(db.Model):
@@ -63,6 +164,10 @@ class Team(db.Model):
     member1_id = db.Column(db.Integer, db.ForeignKey("user.id"), unique=True)
     member2_id = db.Column(db.Integer, db.ForeignKey("user.id"), unique=True)
 
+    # references to the members of this team, loaded from the session when already there
+    member1 = db.relationship("User", foreign_keys=[member1_id])
+    member2 = db.relationship("User", foreign_keys=[member2_id])
+
     # reference to the defences published by this team
     defences = db.relationship(
         "Defence",
@@ -87,12 +192,17 @@ class Team(db.Model):
         lazy="dynamic",
     )
 
+    # reference to the scores of this team in each round
+    round_scores = db.relationship(
+        "TeamRoundScore",
+        backref="team",
+        foreign_keys="TeamRoundScore.team_id",
+        lazy="dynamic",
+    )
+
     def members(self) -> tuple[Optional[User], Optional[User]]:
         """Returns the tuple containing the users this team is composed of (potentially None tuple members if the team is not full)."""
-        return (
-            db.session.query(User).filter(User.id == self.member1_id).first(),
-            db.session.query(User).filter(User.id == self.member2_id).first(),
-        )
+        return self.member1, self.member2
 
     def has_admin(self) -> bool:
         """Returns whether this team has an admin member"""
@@ -140,19 +250,15 @@ class Team(db.Model):
             and_(Match.round == round, Match.defender_team_id == other_team_id)
         )
 
-    def utility_score(self, round) -> Union[float, str]:
-        """Returns either the utility score of this team for Defence in the round, or the error message to be displayed. The considered defence is the most recent one of this round. The highest the score, the least utility consuming the defence is."""
-        defence = (
-            self.defences.filter(Defence.round == round)
-            .order_by(Defence.timestamp.desc())
-            .first()
-        )
-        return (
-            defence.utility.aggregated_score() if defence else "No defence uploaded yet"
-        )
+    def latest_defence(self, round: Optional[int] = None) -> Optional["Defence"]:
+        """Returns the most recent defence of this team in the round, or of all rounds if round is None. This is the defence the current test, train and verification sets come from when round is None."""
+        defences = self.defences
+        if round is not None:
+            defences = defences.filter(Defence.round == round)
+        return defences.order_by(Defence.timestamp.desc()).first()
 
-    def attack_performance(self, round) -> Union[float, str]:
-        """Returns either the attack performance score of this team for Attack in the round, or the error message to be displayed. For each match in the round, only the latest attack is considered for the computation. The returned result is the average of attack performance if all assigned attacks have been performed, the error message string is returned otherwise. The highest score, the better the attack."""
+    def latest_attacks(self, round) -> list["Attack"]:
+        """Returns the most recent attack of this team for each match of the round it already attacked in."""
         atk_matches_in_round = self.attack_matches.filter(
             Match.round == round
         ).subquery()
@@ -169,33 +275,97 @@ class Team(db.Model):
             .subquery()
         )
         # all the Attack objects of the most recent attack for each performed match in this round
-        self_most_recent_atks = (
+        return (
             db.session.query(Attack)
             .join(
                 self_most_recent_atks_rows, Attack.id == self_most_recent_atks_rows.c.id
             )
             .all()
         )
-        return (
-            sum(
-                [attack.results.aggregated_result() for attack in self_most_recent_atks]
-            )
-            / len(
-                self_most_recent_atks
-            )  # we compute the average aggregated result when all matches are done
-            if len(self_most_recent_atks) == Match.nb_matches_in_round(round, self.id)
-            and len(self_most_recent_atks) != 0
-            else "Some attacks remain to do"
-        )
+
+    def duplicate_defence(self, round, digest: str) -> Optional["Defence"]:
+        """Returns the current defence of this team in the round if it comes from an upload with the same content digest, None otherwise. Uploading it again would not change anything."""
+        defence = self.latest_defence(round)
+        return defence if defence is not None and defence.digest == digest else None
+
+    def duplicate_attacks(self, round, digest: str) -> list["Attack"]:
+        """Returns the current attacks of this team in the round if they all come from an upload with the same content digest and none of the attacked teams changed its defence since, an empty list otherwise. Uploading it again would not change anything."""
+        attacks = self.latest_attacks(round)
+        if (
+            len(attacks) == 0
+            or len(attacks) != Match.nb_matches_in_round(round, self.id)
+            or any(attack.digest != digest for attack in attacks)
+        ):
+            return []
+        for attack in attacks:
+            # a new defence means a new verification set, the previous results do not hold anymore
+            defence = attack.match.defender_team.latest_defence()
+            if defence is not None and defence.timestamp > attack.timestamp:
+                return []
+        return attacks
+
+    def round_score(self, round) -> Optional["TeamRoundScore"]:
+        """Returns the stored scores of this team in the round, None if they were never computed"""
+        return self.round_scores.filter(TeamRoundScore.round == round).first()
+
+    def utility_score(self, round) -> Union[float, str]:
+        """Returns either the utility score of this team for Defence in the round, or the error message to be displayed. The considered defence is the most recent one of this round. The highest the score, the least utility consuming the defence is."""
+        score = self.round_score(round)
+        if score is None or score.utility_score is None:
+            return NO_DEFENCE_MESSAGE
+        return score.utility_score
+
+    def attack_performance(self, round) -> Union[float, str]:
+        """Returns either the attack performance score of this team for Attack in the round, or the error message to be displayed. For each match in the round, only the latest attack is considered for the computation. The returned result is the average of attack performance if all assigned attacks have been performed, the error message string is returned otherwise. The highest score, the better the attack."""
+        score = self.round_score(round)
+        if score is None or score.attack_performance is None:
+            return ATTACKS_REMAINING_MESSAGE
+        return score.attack_performance
 
     def total_score(self, round) -> Union[float, str]:
-        """Returns either the aggregated performance score of this team in the round, or the error message to be displayed. The total score is the product of the utility and attack performance metrics. We can see it as (roc_auc_score)/(time_consumption*bandwidth_consumption). If not all attacks are done, the attack perf score is set to 1.0 (this should be less than a random classifier's performance with the current settings and for secretstroll application)"""
-        atk_perf = self.attack_performance(round)
-        util_score = self.utility_score(round)
-        if isinstance(util_score, float):
-            return (atk_perf if isinstance(atk_perf, float) else 1.0) * util_score
-        else:
-            return "Cannot compute full score yet"
+        """Returns either the aggregated performance score of this team in the round, or the error message to be displayed. The total score is the product of the utility and attack performance metrics."""
+        score = self.round_score(round)
+        if score is None or score.total_score is None:
+            return NO_TOTAL_SCORE_MESSAGE
+        return score.total_score
+
+    @staticmethod
+    def leaderboard_items(round: int) -> list[dict]:
+        """Reads the scores of every team in the round with a single query ordered by total score, the teams whose score is not computable yet coming last.
+
+        Args:
+            round: the round of the scores
+
+        Returns:
+            team_items: for each team, by decreasing total score, a dict with its team_name, utility_score, attack_performance and score"""
+        rows = (
+            db.session.query(
+                Team.team_name,
+                TeamRoundScore.utility_score,
+                TeamRoundScore.attack_performance,
+                TeamRoundScore.total_score,
+            )
+            .outerjoin(
+                TeamRoundScore,
+                and_(TeamRoundScore.team_id == Team.id, TeamRoundScore.round == round),
+            )
+            .order_by(TeamRoundScore.total_score.desc().nulls_last(), Team.id)
+            .all()
+        )
+        team_items = []
+        for row in rows:
+            util_score, atk_perf, score = displayed_scores(
+                row.utility_score, row.attack_performance, row.total_score
+            )
+            team_items.append(
+                {
+                    "team_name": row.team_name,
+                    "utility_score": util_score,
+                    "attack_performance": atk_perf,
+                    "score": score,
+                }
+            )
+        return team_items
 
     def __repr__(self) -> str:
         return "<Team {} (id: {})>".format(self.team_name, self.id)
@@ -251,14 +421,71 @@ class Utility:
         )
 
 
+# the metrics of Utility, each stored in a column of Defence
+UTILITY_METRICS = [
+    "max_in_volume",
+    "mean_in_volume",
+    "med_in_volume",
+    "max_out_volume",
+    "mean_out_volume",
+    "med_out_volume",
+    "max_time",
+    "mean_time",
+    "med_time",
+]
+
+
 class Defence(db.Model):
     """Representation a team's defence."""
 
     id = db.Column(db.Integer, primary_key=True)
     defender_team_id = db.Column(db.Integer, db.ForeignKey("team.id"))
-    utility = db.Column(db.PickleType)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     round = db.Column(db.Integer, index=True)
+    digest = db.Column(db.String(64), index=True)  # sha256 of the uploaded file
+    # the utility metrics, see Utility
+    max_in_volume = db.Column(db.BigInteger)
+    mean_in_volume = db.Column(db.Float)
+    med_in_volume = db.Column(db.Float)
+    max_out_volume = db.Column(db.BigInteger)
+    mean_out_volume = db.Column(db.Float)
+    med_out_volume = db.Column(db.Float)
+    max_time = db.Column(db.Float)
+    mean_time = db.Column(db.Float)
+    med_time = db.Column(db.Float)
+    aggregated_score = db.Column(db.Float)  # Utility.aggregated_score()
+    __table_args__ = (
+        # the latest defence of a team in a round is looked up for its scores
+        db.Index(
+            "ix_defence_defender_team_id_round_timestamp",
+            "defender_team_id",
+            "round",
+            "timestamp",
+        ),
+    )
+
+    @property
+    def utility(self) -> Optional[Utility]:
+        """The Utility object holding the utility metrics of this defence, stored in their own columns, the metrics stored as NULL given back as NaN"""
+        # the durations are defined for every upload. The legacy defences without packets in a direction have NULL volumes and aggregated score, the new ones are rejected by verify_dataframe
+        if self.max_time is None:
+            return None
+        return Utility(
+            **{
+                metric: nan if getattr(self, metric) is None else getattr(self, metric)
+                for metric in UTILITY_METRICS
+            }
+        )
+
+    @utility.setter
+    def utility(self, utility: Utility) -> None:
+        for metric, value in utility.to_dict().items():
+            # numpy scalars cannot be stored as is
+            if metric in ("max_in_volume", "max_out_volume"):
+                setattr(self, metric, int(value))
+            else:
+                setattr(self, metric, float(value))
+        self.aggregated_score = float(utility.aggregated_score())
 
     def __repr__(self) -> str:
         return "<Defence of {} (id: {})>".format(self.defender_team, self.id)
@@ -278,6 +505,10 @@ class Match(db.Model):
             "round",
             name="_match_pair_once_per_round",
         ),
+        # the matches of a team are looked up by round and attacker, the unique constraint leads with the defender
+        db.Index("ix_match_round_attacker_team_id", "round", "attacker_team_id"),
+        # the home page lists the matches by keyset on (round, id)
+        db.Index("ix_match_round_id", "round", "id"),
     )
 
     # reference to the attacks performed for this match
@@ -311,23 +542,84 @@ class Match(db.Model):
             - current_user_team: the user we want to make the display adapted for
         Returns:
             Pagination object and the list of itemized Match objects for the displaying on _match.html template"""
-        matches_sub = matches.subquery()
-        # we keep all the indexes of the matches that were already attacked at least once
-        attacks_done = (
-            db.session.query(matches_sub.c.id)
-            .join(Attack, Attack.match_id == matches_sub.c.id)
-            .all()
+        paginated = Match.with_match_done(matches).paginate(
+            page=page, per_page=matches_per_page
         )
-        # we flatten the returned object
-        attacks_done = [attack_done[0] for attack_done in attacks_done]
-
-        paginated = matches.paginate(page, matches_per_page)
-        matches_items = paginated.items
-        for m in matches_items:
-            # takes the paginated items and appends other useful data for displaying
-            m.match_done = m.id in attacks_done
+        matches_items = Match.itemize(paginated.items)
+        paginated.items = matches_items
         return paginated, matches_items
 
+    @staticmethod
+    def keyset_paginate_and_itemize_match_query(
+        matches: Query,
+        matches_per_page: int,
+        after: Optional[tuple[int, int]] = None,
+        before: Optional[tuple[int, int]] = None,
+    ) -> tuple[list["Match"], Optional[tuple[int, int]], Optional[tuple[int, int]]]:
+        """Produces a page of matches items for a _match.html template, by decreasing round and id. The page is designated by the (round, id) cursor of a match next to it instead of its index, so that its cost does not depend on how deep it is and no count is needed.
+
+        Args:
+            matches: a query object on the Match table, not ordered
+            matches_per_page: the number matches to display in the page
+            after: the cursor of the last match of the previous page, None for the first page
+            before: the cursor of the first match of the next page, when going back to newer matches
+
+        Returns:
+            matches_items: the list of itemized Match objects of the page
+            next_cursor: the cursor to pass as after to get the next page, None on the last page
+            prev_cursor: the cursor to pass as before to get the previous page, None on the first page"""
+        if before is not None:
+            round, id = before
+            # we read the newer matches from the closest to the cursor, in increasing order
+            page = matches.filter(
+                Match.round >= round, or_(Match.round > round, Match.id > id)
+            ).order_by(Match.round, Match.id)
+        else:
+            page = matches
+            if after is not None:
+                round, id = after
+                page = page.filter(
+                    Match.round <= round, or_(Match.round < round, Match.id < id)
+                )
+            page = page.order_by(Match.round.desc(), Match.id.desc())
+        # the extra match tells whether there is a page beyond this one
+        rows = Match.with_match_done(page).limit(matches_per_page + 1).all()
+        has_more = len(rows) > matches_per_page
+        matches_items = Match.itemize(rows[:matches_per_page])
+        if before is not None:
+            matches_items.reverse()
+            has_newer, has_older = has_more, True
+        else:
+            has_newer, has_older = after is not None, has_more
+        next_cursor = (
+            matches_items[-1].cursor() if has_older and matches_items else None
+        )
+        prev_cursor = matches_items[0].cursor() if has_newer and matches_items else None
+        return matches_items, next_cursor, prev_cursor
+
+    @staticmethod
+    def with_match_done(matches: Query) -> Query:
+        """Returns a query of (match, match_done) rows from a query on the Match table, with the teams of the matches eager-loaded. Whether each match was attacked is computed by the query, only for the matches it returns."""
+        match_done = (
+            db.session.query(Attack.id).filter(Attack.match_id == Match.id).exists()
+        )
+        return matches.options(
+            joinedload(Match.attacker_team), joinedload(Match.defender_team)
+        ).add_columns(match_done.label("match_done"))
+
+    @staticmethod
+    def itemize(rows: list[tuple["Match", bool]]) -> list["Match"]:
+        """Returns the matches of (match, match_done) rows, with their match_done attribute set for displaying"""
+        matches_items = []
+        for m, done in rows:
+            m.match_done = done
+            matches_items.append(m)
+        return matches_items
+
+    def cursor(self) -> tuple[int, int]:
+        """Returns the (round, id) position of this match in the keyset pagination"""
+        return self.round, self.id
+
     def match_done(self) -> bool:
         """Returns whether the attacker already made an attack or not for this match"""
         return db.session.query(Attack).filter(Attack.match_id == self.id).count() > 0
@@ -363,10 +655,186 @@ class Attack(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     match_id = db.Column(db.Integer, db.ForeignKey("match.id"))
-    results = db.Column(db.PickleType)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    digest = db.Column(db.String(64), index=True)  # sha256 of the uploaded file
+    # the attack performance metrics, see AttackResult
+    accuracy = db.Column(db.Float)
+    roc_auc_score = db.Column(db.Float)
+    aggregated_result = db.Column(db.Float)  # AttackResult.aggregated_result()
+    __table_args__ = (
+        # the latest attack of a match is looked up for the attack performance
+        db.Index("ix_attack_match_id_timestamp", "match_id", "timestamp"),
+    )
+
+    @property
+    def results(self) -> Optional[AttackResult]:
+        """The AttackResult object holding the performance metrics of this attack, stored in their own columns"""
+        if self.aggregated_result is None:
+            return None
+        return AttackResult(accuracy=self.accuracy, roc_auc_score=self.roc_auc_score)
+
+    @results.setter
+    def results(self, results: AttackResult) -> None:
+        self.accuracy = float(results.accuracy)
+        self.roc_auc_score = float(results.roc_auc_score)
+        self.aggregated_result = float(results.aggregated_result())
 
     def __repr__(self) -> str:
         return "<Attack - for match against {}, scored: {}".format(
             self.match.defender_team, self.results
         )
+
+
+class TeamRoundScore(db.Model):
+    """Scores of a team in a round, maintained on write: they are recomputed from the defence and attack history in the transaction committing a defence, attacks or the matches of the round, so that reading them costs the same however long the history is. A score not computable yet is None."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.Integer, db.ForeignKey("team.id"))
+    round = db.Column(db.Integer)
+    utility_score = db.Column(db.Float)
+    attack_performance = db.Column(db.Float)
+    total_score = db.Column(db.Float)
+    completed_matches = db.Column(db.Integer, default=0)
+    nb_matches = db.Column(db.Integer, default=0)
+    __table_args__ = (
+        db.UniqueConstraint("team_id", "round", name="_team_score_once_per_round"),
+        # the leaderboard of a round is read by decreasing total score
+        db.Index("ix_team_round_score_round_total_score", "round", "total_score"),
+    )
+
+    @staticmethod
+    def compute(
+        round: int, team_ids: Optional[list[int]] = None
+    ) -> list["TeamRoundScore"]:
+        """Computes from the defence and attack history the scores of teams in the round, with a single query whatever the number of teams. Window functions select the latest defence of each team and the latest attack of each match, whose aggregated results are averaged by the database.
+
+        Args:
+            round: the round of the scores
+            team_ids: the ids of the teams to compute the scores of, all the teams if None
+
+        Returns:
+            scores: the computed scores, not added to the session"""
+        latest_defences = (
+            db.session.query(
+                Defence.defender_team_id,
+                Defence.aggregated_score,
+                func.row_number()
+                .over(
+                    partition_by=Defence.defender_team_id,
+                    order_by=(Defence.timestamp.desc(), Defence.id.desc()),
+                )
+                .label("recency"),
+            )
+            .filter(Defence.round == round)
+            .subquery()
+        )
+        latest_attacks = (
+            db.session.query(
+                Match.attacker_team_id,
+                Attack.aggregated_result,
+                func.row_number()
+                .over(
+                    partition_by=Attack.match_id,
+                    order_by=(Attack.timestamp.desc(), Attack.id.desc()),
+                )
+                .label("recency"),
+            )
+            .join(Match, Attack.match_id == Match.id)
+            .filter(Match.round == round)
+            .subquery()
+        )
+        attack_results = (
+            db.session.query(
+                latest_attacks.c.attacker_team_id,
+                func.count().label("completed_matches"),
+                func.avg(latest_attacks.c.aggregated_result).label("mean_result"),
+            )
+            .filter(latest_attacks.c.recency == 1)
+            .group_by(latest_attacks.c.attacker_team_id)
+            .subquery()
+        )
+        nb_matches = (
+            db.session.query(
+                Match.attacker_team_id, func.count(Match.id).label("nb_matches")
+            )
+            .filter(Match.round == round)
+            .group_by(Match.attacker_team_id)
+            .subquery()
+        )
+        rows = (
+            db.session.query(
+                Team.id,
+                latest_defences.c.aggregated_score,
+                nb_matches.c.nb_matches,
+                attack_results.c.completed_matches,
+                attack_results.c.mean_result,
+            )
+            .outerjoin(
+                latest_defences,
+                and_(
+                    latest_defences.c.defender_team_id == Team.id,
+                    latest_defences.c.recency == 1,
+                ),
+            )
+            .outerjoin(nb_matches, nb_matches.c.attacker_team_id == Team.id)
+            .outerjoin(attack_results, attack_results.c.attacker_team_id == Team.id)
+            .order_by(Team.id)
+        )
+        if team_ids is not None:
+            rows = rows.filter(Team.id.in_(team_ids))
+        scores = []
+        for row in rows:
+            completed_matches = row.completed_matches or 0
+            nb_matches = row.nb_matches or 0
+            util_score = utility_score_of(row.aggregated_score)
+            atk_perf = attack_performance_of(
+                row.mean_result, completed_matches, nb_matches
+            )
+            total_score = total_score_of(util_score, atk_perf)
+            scores.append(
+                TeamRoundScore(
+                    team_id=row.id,
+                    round=round,
+                    # we only store the scores, the messages are given back when displayed
+                    utility_score=util_score if isinstance(util_score, float) else None,
+                    attack_performance=(
+                        atk_perf if isinstance(atk_perf, float) else None
+                    ),
+                    total_score=total_score if isinstance(total_score, float) else None,
+                    completed_matches=completed_matches,
+                    nb_matches=nb_matches,
+                )
+            )
+        return scores
+
+    @staticmethod
+    def refresh(round: int, team_ids: Optional[list[int]] = None) -> None:
+        """Recomputes the scores of teams in the round and stores them in the session. Does not commit: it is called in the transaction writing the defence, attacks or matches the scores depend on, and holds a lock on the teams until that transaction ends.
+
+        Args:
+            round: the round of the scores
+            team_ids: the ids of the teams to refresh the scores of, all the teams if None"""
+        # we lock the teams' rows until the commit: the tasks refreshing the same team are serialized, each computing from the history committed by the previous one, and a first score of a team is only inserted once. The rows are locked in the order of their ids to avoid deadlocks
+        locked_teams = db.session.query(Team.id).order_by(Team.id).with_for_update()
+        if team_ids is not None:
+            locked_teams = locked_teams.filter(Team.id.in_(team_ids))
+        locked_teams.all()
+        stored_scores = TeamRoundScore.query.filter(TeamRoundScore.round == round)
+        if team_ids is not None:
+            stored_scores = stored_scores.filter(TeamRoundScore.team_id.in_(team_ids))
+        stored_scores = {score.team_id: score for score in stored_scores}
+        for score in TeamRoundScore.compute(round, team_ids):
+            stored_score = stored_scores.get(score.team_id)
+            if stored_score is None:
+                db.session.add(score)
+                continue
+            stored_score.utility_score = score.utility_score
+            stored_score.attack_performance = score.attack_performance
+            stored_score.total_score = score.total_score
+            stored_score.completed_matches = score.completed_matches
+            stored_score.nb_matches = score.nb_matches
+
+    def __repr__(self) -> str:
+        return "<TeamRoundScore of {} in round {}: {}>".format(
+            self.team, self.round, self.total_score
+        )
@@ -0,0 +1,95 @@
+"""Counts the SQL queries and the time spent executing them in each request and each celery task, with SQLAlchemy engine events. The counts are logged, as a warning above QUERY_BUDGET queries, and sent in the X-Query-Count and X-Query-Time headers of the responses when QUERY_STATS_HEADERS is set."""
+
+import time
+from contextvars import ContextVar, Token
+from typing import Optional
+
+from celery.signals import task_postrun, task_prerun
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+QUERY_BUDGET = app.config["QUERY_BUDGET"]
+
+
+class QueryStats:
+    """Number of SQL queries executed and time spent executing them"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+
+    def __repr__(self) -> str:
+        return "{:d} queries in {:.1f} ms".format(self.count, 1000 * self.duration)
+
+
+# the stats of the request or task being handled, None outside of them
+current_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "current_stats", default=None
+)
+# the stats of the celery tasks being run, by task id
+task_stats_tokens: dict[str, Token] = {}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start_time = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += time.perf_counter() - context.query_start_time
+
+
+def report(name: str, stats: QueryStats) -> None:
+    """Logs the query stats of a request or task, as a warning if it exceeds the query budget"""
+    if stats.count > QUERY_BUDGET:
+        app.logger.warning(
+            "{}: {}, over the budget of {:d}".format(name, stats, QUERY_BUDGET)
+        )
+    else:
+        app.logger.debug("{}: {}".format(name, stats))
+
+
+@app.before_request
+def start_request_stats() -> None:
+    g.query_stats_token = current_stats.set(QueryStats())
+
+
+@app.after_request
+def report_request_stats(response: Response) -> Response:
+    stats = current_stats.get()
+    if stats is None:
+        return response
+    report("{} {}".format(request.method, request.path), stats)
+    if app.config["QUERY_STATS_HEADERS"]:
+        response.headers["X-Query-Count"] = str(stats.count)
+        response.headers["X-Query-Time"] = "{:.3f}".format(1000 * stats.duration)
+    return response
+
+
+@app.teardown_request
+def stop_request_stats(exception: Optional[BaseException]) -> None:
+    token = g.pop("query_stats_token", None)
+    if token is not None:
+        current_stats.reset(token)
+
+
+@task_prerun.connect
+def start_task_stats(task_id: str, **kwargs) -> None:
+    task_stats_tokens[task_id] = current_stats.set(QueryStats())
+
+
+@task_postrun.connect
+def stop_task_stats(task_id: str, task, **kwargs) -> None:
+    token = task_stats_tokens.pop(task_id, None)
+    if token is None:
+        return
+    stats = current_stats.get()
+    current_stats.reset(token)
+    report("task {}".format(task.name), stats)
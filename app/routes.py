@@ -1,12 +1,19 @@
 """Router of the application. Serves the different template files and handles user requests"""
 
 import os
-import tempfile
 from datetime import datetime
-from random import shuffle
-from zipfile import ZipFile
 
-from flask import abort, flash, redirect, render_template, request, send_file, url_for
+from flask import (
+    Response,
+    abort,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    url_for,
+)
 from flask_login import (
     current_user,
     fresh_login_required,
@@ -14,41 +21,82 @@ from flask_login import (
     login_user,
     logout_user,
 )
+from sqlalchemy.orm import joinedload
+from werkzeug.datastructures import ContentRange
 from werkzeug.urls import url_parse
 
 from app import app, db
+from app.bundles import Bundle, StoredZip, current_bundle, load_manifest
+from app.datasets import file_digest
 from app.forms import AttackUpload, DefenceUpload, LoginForm, RegistrationForm
-from app.models import Attack, Defence, Match, Team, User
+from app.matchmaking import generate_round_matches
+from app.models import (
+    Attack,
+    Defence,
+    Match,
+    Team,
+    TeamRoundScore,
+    User,
+    forget_identity,
+)
 from app.tasks_attack import treat_uploaded_attack
+from app.tasks_control import build_attack_bundles, build_round_answer_key
 from app.tasks_defence import treat_uploaded_defence
-import time
 from app.cached_items import CachedLeaderboard
 
 
+def match_cursor(value: str) -> tuple[int, int]:
+    """Parses the (round, id) cursor of a match in the keyset pagination, formatted as round_id by format_cursor"""
+    round, id = value.split("_")
+    return int(round), int(id)
+
+
+def format_cursor(cursor: tuple[int, int]) -> str:
+    return "{}_{}".format(*cursor)
+
+
 @app.route("/")
 @app.route("/index", methods=["GET"])
 @login_required
 def index():
-    page = request.args.get("page", 1, type=int)
-    pagination, matches_items = Match.paginate_and_itemize_match_query(
-        db.session.query(Match).order_by(Match.round.desc()),
-        page,
-        app.config["MATCHES_PER_PAGE"],
-        current_user.team(),
+    # an invalid cursor is ignored and gives the first page
+    after = request.args.get("after", None, type=match_cursor)
+    before = request.args.get("before", None, type=match_cursor)
+    # the total is only counted when asked for, it costs a scan of the matches
+    total = request.args.get("total", 0, type=int)
+    (
+        matches_items,
+        next_cursor,
+        prev_cursor,
+    ) = Match.keyset_paginate_and_itemize_match_query(
+        db.session.query(Match), app.config["MATCHES_PER_PAGE"], after, before
     )
+    nb_matches = db.session.query(Match).count() if total else None
     next_url = (
-        url_for("index", page=pagination.next_num) if pagination.has_next else None
+        url_for("index", after=format_cursor(next_cursor), total=total or None)
+        if next_cursor
+        else None
     )
     prev_url = (
-        url_for("index", page=pagination.prev_num) if pagination.has_prev else None
+        url_for("index", before=format_cursor(prev_cursor), total=total or None)
+        if prev_cursor
+        else None
+    )
+    total_url = url_for(
+        "index",
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        total=1,
     )
 
     return render_template(
         "index.html",
         title="Home",
         matches=matches_items,
+        nb_matches=nb_matches,
         next_url=next_url,
         prev_url=prev_url,
+        total_url=total_url,
     )
 
 
@@ -148,6 +196,7 @@ def join_team():
     else:
         team.member2_id = current_user.id
     db.session.commit()
+    forget_identity(current_user.id)
     flash("Congrats, you joined {}".format(team.team_name))
     return redirect(url_for("team", team_name=team.team_name))
 
@@ -191,8 +240,14 @@ def team(team_name):
 
     attacks = (
         team.attacks()
+        .options(
+            joinedload(Attack.match).joinedload(Match.attacker_team),
+            joinedload(Attack.match).joinedload(Match.defender_team),
+        )
         .order_by(Attack.timestamp.desc())
-        .paginate(page_attack, app.config["MATCHES_PER_TEAM"], False)
+        .paginate(
+            page=page_attack, per_page=app.config["MATCHES_PER_TEAM"], error_out=False
+        )
     )
     attack_next_url = (
         url_for(
@@ -249,6 +304,14 @@ def defence():
     form = DefenceUpload()
     if form.validate_on_submit():
         uploaded_file = request.files["file"]
+        digest = file_digest(uploaded_file.stream)
+        uploaded_file.stream.seek(0)
+        if current_user.team().duplicate_defence(app.config["ROUND"], digest):
+            # students often upload the same file again, no need to evaluate it twice
+            flash(
+                "This defence is identical to your current one, its results are unchanged"
+            )
+            return redirect(url_for("team", team_name=current_user.team().team_name))
         filename = "team_{:d}_{:s}_defence.zip".format(
             current_user.team().id, datetime.utcnow().strftime("%m_%d_%Y_%H:%M:%S")
         )
@@ -258,7 +321,7 @@ def defence():
         # we save the file to the temporary upload folder
         uploaded_file.save(save_path)
         # we start the asynchronous job
-        treat_uploaded_defence.delay(filename, current_user.id)
+        treat_uploaded_defence.delay(filename, current_user.id, digest)
         flash(
             "Defence received! Evaluation in process, you will receive results by email shortly"
         )
@@ -267,6 +330,33 @@ def defence():
     return render_template("upload_def.html", form=form)
 
 
+def current_user_bundle() -> Bundle:
+    """Returns the current bundle of the sets the team of the current user attacks in the round, aborting if there is none"""
+    try:
+        bundle = current_bundle(current_user.team().id, app.config["ROUND"])
+    except FileNotFoundError as error:
+        flash("File not found: {:s}".format(os.path.basename(error.filename)))
+        abort(404)
+    if bundle is None:
+        flash("You have no match yet for this round")
+        abort(404)
+    return bundle
+
+
+@app.route("/attack/manifest", methods=["GET"])
+@login_required
+def attack_manifest():
+    """Lists the sets of the team's bundle with their digest and its version, to download only the sets changed since a version with /attack/?download=1&since=<version>"""
+    if not app.config["ATTACK_PHASE"]:
+        abort(503)
+    if not current_user.has_team():
+        abort(503)
+    bundle = current_user_bundle()
+    response = jsonify(bundle.manifest())
+    response.set_etag(bundle.version)
+    return response.make_conditional(request)
+
+
 @app.route("/attack/", methods=["GET", "POST"])
 @login_required
 def attack():
@@ -278,47 +368,57 @@ def attack():
         abort(503)
     download = request.args.get("download", False, type=bool)
     if download:
-        nb_def_matches_in_round = (
-            current_user.team()
-            .defence_matches_in_round(round=app.config["ROUND"])
-            .count()
+        bundle = current_user_bundle()
+        since = request.args.get("since", None, type=str)
+        previous_manifest = (
+            load_manifest(bundle.attacker_id, bundle.round, since) if since else None
         )
-        if nb_def_matches_in_round < 1:
-            flash("You have no match yet for this round")
-            abort(404)
-
-        team_id_to_attack = current_user.team().team_id_to_attack_in_round(
-            round=app.config["ROUND"]
-        )
-        files_to_send = [
-            app.config["TEST_FILENAME_FORMAT"].format(team_id)
-            for team_id in team_id_to_attack
-        ] + [
-            app.config["TRAIN_FILENAME_FORMAT"].format(team_id)
-            for team_id in team_id_to_attack
-        ]
-
-        # we create a temporary file so it's not kept on the server to avoid explosion of number of files
-        _, temp_file = tempfile.mkstemp(".zip")
-        # we send a zipfile containing all the test and train sets of the teams to attack
-        with ZipFile(temp_file, "w") as zip:
-            for file in files_to_send:
-                try:
-                    zip.write(
-                        os.path.join(app.root_path, app.config["UPLOAD_FOLDER"], file),
-                        arcname=os.path.split(file)[1],
-                    )
-                except FileNotFoundError:
-                    flash("File not found: {:s}".format(file))
-                    abort(404)
-        file_to_send_name = "user_{:d}_round_{:d}_sets_to_attack.zip".format(
-            current_user.id, app.config["ROUND"]
-        )
-        return send_file(temp_file, download_name=file_to_send_name)
+        if previous_manifest is not None:
+            # only the sets changed since the version the team already has are sent, an unknown version gets the whole bundle
+            delta_name = "user_{:d}_round_{:d}_sets_to_attack_since_{:s}.zip".format(
+                current_user.id, bundle.round, since
+            )
+            response = send_stored_zip(
+                bundle.delta(previous_manifest),
+                "{}-{}".format(since, bundle.version),
+                delta_name,
+            )
+        else:
+            file_to_send_name = "user_{:d}_round_{:d}_sets_to_attack.zip".format(
+                current_user.id, bundle.round
+            )
+            if bundle.is_built():
+                # the bundle was built when the matches were generated or the last defence changed
+                response = send_file(
+                    bundle.path,
+                    download_name=file_to_send_name,
+                    as_attachment=True,
+                    etag=bundle.version,
+                )
+            else:
+                # the same bytes are streamed from the sets until the bundle is built
+                response = send_stored_zip(
+                    bundle.zip, bundle.version, file_to_send_name
+                )
+        response.headers["X-Bundle-Version"] = bundle.version
+        return response
 
     form = AttackUpload()
     if form.validate_on_submit():
         uploaded_file = request.files["file"]
+        digest = file_digest(uploaded_file.stream)
+        uploaded_file.stream.seek(0)
+        duplicate_attacks = current_user.team().duplicate_attacks(
+            app.config["ROUND"], digest
+        )
+        if duplicate_attacks:
+            # students often upload the same file again, no need to evaluate it twice
+            flash(
+                "This attack is identical to your current one, its results are unchanged: {}".format(
+                    "".join(attack.__repr__() for attack in duplicate_attacks)
+                )
+            )
+            return redirect(url_for("team", team_name=current_user.team().team_name))
         filename = "team_{:d}_{:s}_attack.zip".format(
             current_user.team().id, datetime.utcnow().strftime("%m_%d_%Y_%H:%M:%S")
         )
@@ -328,7 +428,7 @@ def attack():
         # we save the file to the temporary upload folder
         uploaded_file.save(save_path)
         # we start the asynchronous job
-        treat_uploaded_attack.delay(filename, current_user.id)
+        treat_uploaded_attack.delay(filename, current_user.id, digest)
         flash(
             "Attack received! Evaluation in process, you will receive results by email shortly"
         )
@@ -336,43 +436,70 @@ def attack():
     return render_template("attack.html", form=form)
 
 
-@app.route("/leaderboard/", methods=["GET"])
-@login_required
-def leaderboard():
-    team_items = dict()
-    # to avoid triggering calculation on this hot page, we cache the leaderboard results
+def send_stored_zip(stored_zip: StoredZip, etag: str, download_name: str) -> Response:
+    """Streams a stored zip archive as an attachment, like send_file does for a file: a request whose If-None-Match holds the etag is answered with 304 Not Modified, one with a single byte range with 206 Partial Content.
+
+    Args:
+        stored_zip: the archive to send
+        etag: the strong entity tag identifying the content of the archive
+        download_name: the name of the file suggested to the browser
+
+    Returns:
+        response: the streamed response"""
+    response = Response(mimetype="application/zip", direct_passthrough=True)
+    response.headers["Content-Disposition"] = "attachment; filename={}".format(
+        download_name
+    )
+    response.accept_ranges = "bytes"
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    start, end = 0, stored_zip.size
+    # a range is ignored if If-Range designates a previous version of the archive, or holds a date: the streamed archive has no modification date to compare it with
     if (
-        CachedLeaderboard.leaderboard is None
-        or time.time() - CachedLeaderboard.last_update
-        > app.config["LEADERBOARD_CACHE_TIME"]
+        request.range is not None
+        and request.if_range.date is None
+        and request.if_range.etag in (None, etag)
     ):
-        teams = Team.query.all()
-        team_items = [
-            {
-                "team_name": team.team_name,
-                "utility_score": team.utility_score(app.config["ROUND"]),
-                "attack_performance": team.attack_performance(app.config["ROUND"]),
-                "score": team.total_score(app.config["ROUND"]),
-            }
-            for team in teams
-        ]
-        # we sort teams by their total score, set to -1 by default if score not computable
-        team_items = sorted(
-            team_items,
-            key=lambda x: x["score"] if isinstance(x["score"], float) else -1.0,
-            reverse=True,
-        )
+        bounds = request.range.range_for_length(stored_zip.size)
+        if bounds is not None:
+            start, end = bounds
+            response.status_code = 206
+            response.content_range = ContentRange("bytes", start, end, stored_zip.size)
+        elif len(request.range.ranges) == 1:
+            response.status_code = 416
+            # the unsatisfied range gets "Content-Range: bytes */size"
+            response.content_range = ContentRange("bytes", None, None, stored_zip.size)
+            return response
+        # several ranges are answered with the whole archive
+    response.response = stored_zip.iter_bytes(start, end)
+    response.content_length = end - start
+    return response
+
+
+def ranked_leaderboard_items(round: int) -> list[dict]:
+    """Returns the leaderboard items of the round, ranked and with formatted scores"""
+    # the teams are sorted by their total score, those whose score is not computable coming last
+    team_items = Team.leaderboard_items(round)
+    for rank, team_item in enumerate(team_items):
+        team_item["ranking"] = rank + 1
+        for key, val in team_item.items():
+            if isinstance(val, float):
+                # we apply format only to the float score, others are error messages
+                team_item[key] = "{:,.2f}".format(val)
+    return team_items
 
-        for rank, team_item in enumerate(team_items):
-            team_item["ranking"] = rank + 1
-            for key, val in team_item.items():
-                if isinstance(val, float):
-                    # we apply format only to the float score, others are error messages
-                    team_item[key] = "{:,.2f}".format(val)
-        CachedLeaderboard.last_update = time.time()
-        CachedLeaderboard.leaderboard = team_items
-    else:
-        team_items = CachedLeaderboard.leaderboard
+
+@app.route("/leaderboard/", methods=["GET"])
+@login_required
+def leaderboard():
+    round = app.config["ROUND"]
+    # to avoid triggering calculation on this hot page, we cache the leaderboard results, shared by all processes
+    team_items = CachedLeaderboard.get(round, lambda: ranked_leaderboard_items(round))
+    if team_items is None:
+        flash("The leaderboard is being computed, please reload the page in a moment")
+        team_items = []
     return render_template("leaderboard.html", team_items=team_items)
 
 
@@ -405,26 +532,17 @@ def generate_matches():
     ):
         flash("You have not generated the matches for round {}".format(round - 1))
         abort(400)
-    # we only keep teams of participants non-admin
-    all_teams = [t for t in Team.query.all() if not t.has_admin()]
-    nb_teams = len(all_teams)
-    # we make sure not to have more than nb_teams-1 matches per team to avoid self-matching
-    matches_per_team = min([app.config["MATCHES_PER_TEAM"], nb_teams - 1])
-    # we shuffle the whole teams list to have random matches
-    shuffle(all_teams)
-    for team_index in range(nb_teams):
-        for match_index in range(1, matches_per_team + 1):
-            # we circle through the shuffled participants list
-            # every team is matched to adversaries in indexes after theirs
-            # it makes sure they have random adversaries that are not themselves
-            m = Match(
-                attacker_team_id=all_teams[team_index].id,
-                defender_team_id=all_teams[(team_index + match_index) % nb_teams].id,
-                round=round,
-            )
-            db.session.add(m)
+    # the teams with an admin member do not play
+    generate_round_matches(round)
+    # every team now has matches to attack in the round
+    TeamRoundScore.refresh(round)
     db.session.commit()
+    CachedLeaderboard.invalidate(round)
     app.config["ROUND"] = round
+    # the attacks of the round will be evaluated against its answer key
+    build_round_answer_key.delay(round)
+    # and the teams download the sets to attack from prebuilt bundles
+    build_attack_bundles.delay(round)
     return redirect(url_for("index"))
 
 
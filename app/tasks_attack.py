@@ -2,27 +2,83 @@
 
 
 import os
+import re
+from typing import Optional
 
-import pandas as pd
-from pandas import DataFrame
-from sklearn.metrics import accuracy_score, roc_auc_score
+import numpy as np
+from pandas import DataFrame, Index
 
 from app import app, celery, db
-from app.models import Attack, AttackResult, Match, Team, User
+from app.answer_keys import AnswerKey, load_answer_key
+from app.cached_items import CachedLeaderboard
+from app.datasets import read_csv
+from app.metrics import one_vs_rest_roc_auc
+from app.models import Attack, AttackResult, Team, TeamRoundScore, User
 from app.tasks_control import send_mail
 
-CLASS_NAME = app.config["DEFENCE_COLUMNS"][0]
 NB_TRACES_TO_CLASSIFY = app.config["NB_TRACES_TO_CLASSIFY"]
 TEAM_ID_NAME = app.config["ATTACK_COLUMNS"][0]
 CAPTURE_NAME = app.config["ATTACK_COLUMNS"][1]
 PROBA_CLASS_REGEX = app.config["PROBA_CLASS_PREFIX"] + "\d+"
+# number of faulty values cited in the error messages
+NB_ERRORS_REPORTED = 5
 
 
-def verify_attack(df: DataFrame, team: Team) -> tuple[bool, str]:
-    """Verifies if the uploaded file corresponds to expectations and can be evaluated correctly.
+def summarize(values) -> str:
+    """Returns a bounded string representation of the values, citing at most NB_ERRORS_REPORTED of them"""
+    cited = ", ".join(str(value) for value in values[:NB_ERRORS_REPORTED])
+    if len(values) > NB_ERRORS_REPORTED:
+        cited += ", ..."
+    return "[{}]".format(cited)
+
+
+def proba_columns(columns: Index) -> tuple[list[str], np.ndarray]:
+    """Resolves once the probability columns of an uploaded attack.
+
+    Args:
+        columns: the columns of the uploaded dataframe
+
+    Returns:
+        names: the names of the probability columns, ordered by class id
+        classes: the class id of each column in names"""
+    names = [col for col in columns if re.fullmatch(PROBA_CLASS_REGEX, col)]
+    # we use the fact that the class id is present in the column's name
+    classes = np.array(
+        [int(col[len(app.config["PROBA_CLASS_PREFIX"]) :]) for col in names]
+    )
+    order = np.argsort(classes, kind="stable")
+    return [names[i] for i in order], classes[order]
+
+
+def group_by_team(
+    team_ids: np.ndarray, capture_ids: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Groups the rows of an uploaded attack by attacked team with a single sort, rows of a team being sorted by capture id as its verification set.
+
+    Args:
+        team_ids: the attacked team id of each row
+        capture_ids: the classified capture id of each row
+
+    Returns:
+        order: the permutation of the rows grouping them by team then capture id
+        attacked_ids: the id of each attacked team, in order of their groups
+        bounds: the group of attacked_ids[i] holds the rows order[bounds[i]:bounds[i + 1]]"""
+    order = np.lexsort((capture_ids, team_ids))
+    sorted_team_ids = team_ids[order]
+    starts = np.flatnonzero(
+        np.concatenate(([True], sorted_team_ids[1:] != sorted_team_ids[:-1]))
+    )
+    return order, sorted_team_ids[starts], np.append(starts, len(order))
+
+
+def verify_attack(
+    df: DataFrame, team: Team, answer_key: Optional[AnswerKey] = None
+) -> tuple[bool, str]:
+    """Verifies if the uploaded file corresponds to expectations and can be evaluated correctly. The rows are grouped by attacked team with a single sort and the probabilities are checked on a matrix extracted once, so that the error messages only summarize the first errors.
 
     Args:
         df: the dataframe containing the data uploaded by the users
+        answer_key: the answer key of the current round, loaded if None
 
     Returns:
         verified: whether the verification succeeded or not
@@ -32,109 +88,115 @@ def verify_attack(df: DataFrame, team: Team) -> tuple[bool, str]:
             False,
             "Your file does not have the correct columns.\nPlease follow the upload instructions.\n",
         )
-    if len(df.index) != NB_TRACES_TO_CLASSIFY * Match.nb_matches_in_round(
-        app.config["ROUND"], team.id
-    ):
+    if answer_key is None:
+        answer_key = load_answer_key(app.config["ROUND"])
+    target_ids, _ = answer_key.targets(team.id)
+    nb_matches = len(target_ids)
+    if len(df.index) != NB_TRACES_TO_CLASSIFY * nb_matches:
         return (
             False,
             "Your file does not contain classification for every trace you should attack: expected: {:d}, have: {:d}".format(
-                NB_TRACES_TO_CLASSIFY
-                * Match.nb_matches_in_round(app.config["ROUND"], team.id),
+                NB_TRACES_TO_CLASSIFY * nb_matches,
                 len(df.index),
             ),
         )
-    if set(df[TEAM_ID_NAME].drop_duplicates()) != set(
-        team.team_id_to_attack_in_round(app.config["ROUND"])
-    ):
+    team_ids = df[TEAM_ID_NAME].to_numpy()
+    capture_ids = df[CAPTURE_NAME].to_numpy()
+    order, attacked_ids, bounds = group_by_team(team_ids, capture_ids)
+    if not np.array_equal(attacked_ids, target_ids):
         return (
             False,
             "Your file contains attacks against teams you should not attack or does not attack all teams you should attack",
         )
-    for attacked_id in team.team_id_to_attack_in_round(app.config["ROUND"]):
-        # we verify if we have some bad or missing capture id classified
-        verif_file_path = os.path.join(
-            app.root_path,
-            app.config["UPLOAD_FOLDER"],
-            app.config["VERIF_FILENAME_FORMAT"].format(attacked_id),
-        )
-        verif_df_capture_id = set(
-            pd.read_csv(verif_file_path)[CAPTURE_NAME].drop_duplicates()
-        )
-        if (
-            set(df[df[TEAM_ID_NAME] == attacked_id][CAPTURE_NAME].drop_duplicates())
-            != verif_df_capture_id
-        ):
+    sorted_capture_ids = capture_ids[order]
+    for attacked_id, start, end in zip(attacked_ids, bounds[:-1], bounds[1:]):
+        # both arrays are sorted, any bad, missing or repeated capture id makes them differ
+        verif_capture_ids, _ = answer_key.verification_set(attacked_id)
+        attacked_capture_ids = sorted_capture_ids[start:end]
+        if not np.array_equal(attacked_capture_ids, verif_capture_ids):
+            invalid_ids = np.setdiff1d(attacked_capture_ids, verif_capture_ids)
+            missing_ids = np.setdiff1d(verif_capture_ids, attacked_capture_ids)
             return (
                 False,
-                f"Your file contains invalid capture_id indexes.",
+                "Your file contains invalid capture_id indexes against team {:d}: {:d} unknown {}, {:d} missing {}".format(
+                    attacked_id,
+                    len(invalid_ids),
+                    summarize(invalid_ids),
+                    len(missing_ids),
+                    summarize(missing_ids),
+                ),
             )
-    if (
-        not (abs(df.filter(regex=PROBA_CLASS_REGEX) - 0.5) <= 0.5).all().all()
-        or not (
-            abs(df.filter(regex=PROBA_CLASS_REGEX).sum(axis=1) - 1.0) <= 10 ** (-10)
-        ).all()
-    ):
-        # we must take care of the floating point precision in the sum to verify if our probabilities sum to 1
+    names, _ = proba_columns(df.columns)
+    proba_classif = df[names].to_numpy(dtype=np.float64)
+    # we must take care of the floating point precision in the sum to verify if our probabilities sum to 1, comparisons with NaN are False
+    invalid_rows = ~(
+        (np.abs(proba_classif - 0.5).max(axis=1) <= 0.5)
+        & (np.abs(proba_classif.sum(axis=1) - 1.0) <= 10 ** (-10))
+    )
+    if invalid_rows.any():
         return (
             False,
-            f"Your output probabilities are not a valid distribution: {df.filter(regex=PROBA_CLASS_REGEX)}",
+            "Your output probabilities are not a valid distribution for {:d} rows, (team_id, capture_id) {}".format(
+                invalid_rows.sum(),
+                summarize(
+                    list(
+                        zip(
+                            team_ids[invalid_rows].tolist(),
+                            capture_ids[invalid_rows].tolist(),
+                        )
+                    )
+                ),
+            ),
         )
     return True, ""
 
 
-def evaluate_attack_perf(df: DataFrame, team: Team) -> list[Attack]:
-    """Evaluates the attack metrics scored by the uploaded attack classification.
+def evaluate_attack_perf(
+    df: DataFrame, team: Team, answer_key: Optional[AnswerKey] = None
+) -> list[Attack]:
+    """Evaluates the attack metrics scored by the uploaded attack classification. The probabilities are extracted once as a contiguous matrix whose rows are grouped by attacked team, so that all the matches are scored in a batch.
 
     Args:
         df: the dataframe containing the data uploaded by the users
+        answer_key: the answer key of the current round, loaded if None
 
     Returns:
         performed_attacks: the list of Attack objects holding the result of every attack to be pushed to db"""
+    names, classes = proba_columns(df.columns)
+    order, attacked_ids, bounds = group_by_team(
+        df[TEAM_ID_NAME].to_numpy(), df[CAPTURE_NAME].to_numpy()
+    )
+    proba_classif = np.ascontiguousarray(df[names].to_numpy(dtype=np.float64)[order])
+    # we take the label classified with highest prob as hard classification to have accuracy
+    classif = classes[proba_classif.argmax(axis=1)]
+    if answer_key is None:
+        answer_key = load_answer_key(app.config["ROUND"])
+    # from the verification we already know the attacked teams are the sorted targets
+    _, match_ids = answer_key.targets(team.id)
     performed_attacks = []
-    for attacked_id in team.team_id_to_attack_in_round(app.config["ROUND"]):
-        verif_file_path = os.path.join(
-            app.root_path,
-            app.config["UPLOAD_FOLDER"],
-            app.config["VERIF_FILENAME_FORMAT"].format(attacked_id),
-        )
-
-        true_labels = pd.read_csv(verif_file_path)[CLASS_NAME].to_numpy()
-        # we take the full proba classification against the attacked team
-        proba_classif = (
-            df[df[TEAM_ID_NAME] == attacked_id]
-            .filter(regex=PROBA_CLASS_REGEX)
-            .to_numpy()
-        )
-        # we get the hard classification to have accuracy
-        classif = (
-            df[df[TEAM_ID_NAME] == attacked_id]
-            .filter(regex=PROBA_CLASS_REGEX)
-            .idxmax(axis=1)  # we take column of the label classified with highest prob
-            .apply(
-                lambda x: int(x.split("_")[-1])
-            )  # we use the fact that the class id is present in the column's name
-            .to_numpy()
-        )
+    for attacked_id, match_id, start, end in zip(
+        attacked_ids, match_ids, bounds[:-1], bounds[1:]
+    ):
+        # the verification set is sorted by capture_id, as the rows of this team's group
+        _, true_labels = answer_key.verification_set(attacked_id)
         results = AttackResult(
-            accuracy=accuracy_score(true_labels, classif),
-            roc_auc_score=roc_auc_score(true_labels, proba_classif, multi_class="ovr"),
+            accuracy=float(np.mean(classif[start:end] == true_labels)),
+            roc_auc_score=one_vs_rest_roc_auc(
+                true_labels, proba_classif[start:end], classes
+            ),
         )
-        # from the previous queries we already know this match should exist
-        evaluated_match = team.get_match_against(
-            app.config["ROUND"], attacked_id
-        ).first()
-
-        performed_attacks.append(Attack(match_id=evaluated_match.id, results=results))
+        performed_attacks.append(Attack(match_id=int(match_id), results=results))
     return performed_attacks
 
 
 @celery.task
-def treat_uploaded_attack(filename: str, user_id: int) -> None:
+def treat_uploaded_attack(filename: str, user_id: int, digest: str = None) -> None:
     """Deals with a file uploaded for attack from its verification to the evaluation of its performance. Made to be triggered asynchronously and handled by a celery worker. Once done, all the attacks for this user in the current round are pushed to the database. Depends on the application and here is only valid in the context of network fingerprinting.
 
     Args:
         filename: the filename of the file uploaded by user and saved in the temporary upload folder
         user_id: the id of the user we are evaluating the defence of (passing user_id is easier to pass than User object as the arguments are serialized and sent to the celery workers)
+        digest: the sha256 digest of the uploaded file, stored to recognize identical uploads
 
     """
     # The task is called only is the user had a team
@@ -146,12 +208,25 @@ def treat_uploaded_attack(filename: str, user_id: int) -> None:
     )
     error_msg = ""
     try:
-        df = pd.read_csv(filepath)
-        ok_df, error_msg = verify_attack(df, team)
+        try:
+            df = read_csv(filepath)
+        except ValueError:
+            ok_df, error_msg = (
+                False,
+                "Your file contains values of the wrong type: team_id and capture_id should be integers, the probabilities numbers",
+            )
+        else:
+            answer_key = load_answer_key(app.config["ROUND"])
+            ok_df, error_msg = verify_attack(df, team, answer_key)
         if ok_df:
-            performed_attacks = evaluate_attack_perf(df, team)
+            performed_attacks = evaluate_attack_perf(df, team, answer_key)
+            for attack in performed_attacks:
+                attack.digest = digest
             db.session.add_all(performed_attacks)
+            # the team's scores are updated in the same transaction as its attacks
+            TeamRoundScore.refresh(app.config["ROUND"], [team.id])
             db.session.commit()
+            CachedLeaderboard.invalidate(app.config["ROUND"])
 
             attacks_repr = ""
             for a in performed_attacks:
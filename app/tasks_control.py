@@ -2,11 +2,13 @@
 
 
 from smtplib import SMTPAuthenticationError, SMTPServerDisconnected
-from typing import Any
+from typing import Any, Optional
 
 from flask_mail import Message
 
 from app import app, celery, mail
+from app.answer_keys import build_answer_key
+from app.bundles import build_round_bundles
 
 
 @celery.task
@@ -38,4 +40,25 @@ def send_mail(
         except SMTPServerDisconnected:
             print("Please, verify your connection parameters for mail support", flush=True)
         except SMTPAuthenticationError:
-            print("Please, verify your connection parameters for mail support", flush=True)
\ No newline at end of file
+            print("Please, verify your connection parameters for mail support", flush=True)
+
+
+@celery.task
+def build_round_answer_key(round: int) -> None:
+    """Builds asynchronously with a celery job the answer key the attacks of the round are evaluated against.
+
+    Args:
+        round: the round whose matches were just generated"""
+    with app.app_context():
+        build_answer_key(round)
+
+
+@celery.task
+def build_attack_bundles(round: int, defender_id: Optional[int] = None) -> None:
+    """Builds asynchronously with a celery job the bundles of sets the teams download to attack in the round.
+
+    Args:
+        round: the round of the matches
+        defender_id: if given, only the bundles of the teams attacking this team are built, after its defence changed"""
+    with app.app_context():
+        build_round_bundles(round, defender_id)
@@ -1,16 +1,23 @@
 """Defines the tasks and jobs triggered when a user uploads a defence dataset. Handles from the upload to saving the train, test and verification sets to files and saving utility results to the database."""
 
 import os
-import secrets
-import sys
-from hashlib import sha256
 
+import numpy as np
 import pandas as pd
-from pandas import DataFrame
+from pandas import DataFrame, Index
 
 from app import app, celery, db
-from app.models import Defence, User, Utility
-from app.tasks_control import send_mail
+from app.answer_keys import refresh_answer_key
+from app.cached_items import CachedLeaderboard
+from app.datasets import (
+    read_csv,
+    read_csv_chunks,
+    read_csv_header,
+    save_dataset,
+    save_features,
+)
+from app.models import Defence, TeamRoundScore, User, Utility
+from app.tasks_control import build_attack_bundles, send_mail
 
 # convenient as called multiple times in this code. Those should not be changed during runtime in any case
 CLASS_NAME = app.config["DEFENCE_COLUMNS"][0]
@@ -18,109 +25,265 @@ REP_NAME = app.config["DEFENCE_COLUMNS"][1]
 MEAN_NB_REP_PER_CLASS = app.config["MEAN_NB_REP_PER_CLASS"]
 DEVIATION_NB_REP_PER_CLASS = app.config["DEVIATION_NB_REP_PER_CLASS"]
 ROWS_PER_CAPTURE = app.config["ROWS_PER_CAPTURE"]
+DEFENCE_CHUNK_SIZE = app.config["DEFENCE_CHUNK_SIZE"]
+MAX_FEATURE_CELLS = app.config["MAX_FEATURE_CELLS"]
 NB_CLASSES = app.config["NB_CLASSES"]
 CAPTURE_NAME = app.config["ATTACK_COLUMNS"][1]
 
 
-def verify_dataframe(df: DataFrame) -> tuple[bool, str]:
-    """Verifies if the uploaded dataset corresponds to expectations and can be evaluated correctly.
+def _reduce_by_capture(
+    classes: np.ndarray,
+    reps: np.ndarray,
+    nb_packets: np.ndarray,
+    in_volume: np.ndarray,
+    out_volume: np.ndarray,
+    duration: np.ndarray,
+) -> DataFrame:
+    """Reduces per row (or per partial capture) values into one row per (class, rep) pair with a single sort followed by numpy segment reductions.
+
+    Returns:
+        summary: dataframe indexed by the (class, rep) pairs with columns 'nb_packets', 'in_volume', 'out_volume' and 'duration'
+    """
+    order = np.lexsort((reps, classes))
+    classes, reps = classes[order], reps[order]
+    # a segment starts wherever the (class, rep) pair changes in the sorted keys
+    starts = np.flatnonzero(
+        np.concatenate(
+            ([True], (classes[1:] != classes[:-1]) | (reps[1:] != reps[:-1]))
+        )
+    )
+    return DataFrame(
+        {
+            "nb_packets": np.add.reduceat(nb_packets[order], starts),
+            "in_volume": np.add.reduceat(in_volume[order], starts),
+            "out_volume": np.add.reduceat(out_volume[order], starts),
+            "duration": np.maximum.reduceat(duration[order], starts),
+        },
+        index=pd.MultiIndex.from_arrays(
+            [classes[starts], reps[starts]], names=[CLASS_NAME, REP_NAME]
+        ),
+    )
+
+
+def summarize_captures(df: DataFrame) -> DataFrame:
+    """Aggregates the rows of an uploaded dataset (or of a chunk of it) into one row per capture, holding everything the verification and the utility evaluation need. Done in a single pass over the rows.
 
     Args:
-        df: the dataframe containing the data uploaded by the users
+        df: the dataframe containing (part of) the data uploaded by the users. Expected to have columns 'direction_size' and 'timestamp'
+
+    Returns:
+        summary: dataframe indexed by the (class, rep) pairs with columns 'nb_packets', 'in_volume', 'out_volume' and 'duration'
+    """
+    # we sum on 64 bits to avoid any overflow on large captures
+    sizes = df["direction_size"].to_numpy(dtype=np.int64)
+    return _reduce_by_capture(
+        df[CLASS_NAME].to_numpy(),
+        df[REP_NAME].to_numpy(),
+        np.ones(len(sizes), dtype=np.int64),
+        np.minimum(sizes, 0),
+        np.maximum(sizes, 0),
+        df["timestamp"].to_numpy(dtype=np.float64),
+    )
+
+
+def merge_capture_summaries(summaries: list[DataFrame]) -> DataFrame:
+    """Merges partial per capture summaries, as a capture can be split between two chunks of the uploaded file.
+
+    Args:
+        summaries: the summaries produced by summarize_captures
+
+    Returns:
+        summary: a single summary holding one row per capture"""
+    summary = pd.concat(summaries)
+    return _reduce_by_capture(
+        summary.index.get_level_values(0).to_numpy(),
+        summary.index.get_level_values(1).to_numpy(),
+        summary["nb_packets"].to_numpy(),
+        summary["in_volume"].to_numpy(),
+        summary["out_volume"].to_numpy(),
+        summary["duration"].to_numpy(),
+    )
+
+
+def stream_capture_summary(
+    filepath: str, chunksize: int = DEFENCE_CHUNK_SIZE
+) -> DataFrame:
+    """Reads the uploaded file by chunks of bounded size and builds the per capture summary on the fly. Only the current chunk and the running summary are kept in memory.
+
+    Args:
+        filepath: path to the uploaded compressed csv file
+        chunksize: the number of rows read at once
+
+    Returns:
+        summary: the per capture summary of the whole uploaded file
+
+    Raises:
+        ValueError: if a column holds values that do not fit its type"""
+    summary = None
+    for chunk in read_csv_chunks(filepath, chunksize):
+        chunk_summary = summarize_captures(chunk)
+        summary = (
+            chunk_summary
+            if summary is None
+            else merge_capture_summaries([summary, chunk_summary])
+        )
+    return summary
+
+
+def verify_columns(columns: Index) -> tuple[bool, str]:
+    """Verifies if the uploaded dataset has the expected columns, before reading its content.
+
+    Args:
+        columns: the column names of the uploaded dataset
 
     Returns:
         verified: whether the verification succeeded or not
         error_msg: a string error message to eventually include in a mail feedback"""
     # sets remove dependency on the order
-    if set(df.columns) != set(app.config["DEFENCE_COLUMNS"]):
+    if set(columns) != set(app.config["DEFENCE_COLUMNS"]):
         return (
             False,
             "Your dataset does not have the correct columns.\nPlease follow the upload instructions.\n",
         )
-    if df[CLASS_NAME].drop_duplicates().count() != NB_CLASSES:
+    return True, ""
+
+
+def verify_dataframe(summary: DataFrame) -> tuple[bool, str]:
+    """Verifies if the uploaded dataset corresponds to expectations and can be evaluated correctly.
+
+    Args:
+        summary: the per capture summary of the data uploaded by the users
+
+    Returns:
+        verified: whether the verification succeeded or not
+        error_msg: a string error message to eventually include in a mail feedback"""
+    if summary is None:
         return (
             False,
             "Your dataset does not contain captures for every cell_id",
         )
-    rep_per_class = (
-        df[[CLASS_NAME, REP_NAME]].drop_duplicates().groupby(CLASS_NAME).count()
+    # the summary has one row per capture, counting the rows per class gives the number of repetitions
+    _, rep_per_class = np.unique(
+        summary.index.get_level_values(0).to_numpy(), return_counts=True
     )
-    if (
-        not (abs(rep_per_class - MEAN_NB_REP_PER_CLASS) < DEVIATION_NB_REP_PER_CLASS)
-        .all()
-        .bool()
-    ):
+    if len(rep_per_class) != NB_CLASSES:
+        return (
+            False,
+            "Your dataset does not contain captures for every cell_id",
+        )
+    if not (
+        np.abs(rep_per_class - MEAN_NB_REP_PER_CLASS) < DEVIATION_NB_REP_PER_CLASS
+    ).all():
         return (
             False,
             f"Your dataset does not contain between {MEAN_NB_REP_PER_CLASS-DEVIATION_NB_REP_PER_CLASS} and {MEAN_NB_REP_PER_CLASS+DEVIATION_NB_REP_PER_CLASS} repetition per class",
         )
-    rows_per_capture = df.groupby([CLASS_NAME, REP_NAME]).count()
-    if not (rows_per_capture > ROWS_PER_CAPTURE).all().all():
+    if not (summary["nb_packets"].to_numpy() > ROWS_PER_CAPTURE).all():
         return (
             False,
             f"Some of your traces contain less that {ROWS_PER_CAPTURE} packets for a query",
         )
+    # the utility score divides by the log of the product of the median volumes and duration, it must be defined
+    utility = evaluate_utility(summary)
+    if np.isnan(utility.med_in_volume) or np.isnan(utility.med_out_volume):
+        return (
+            False,
+            "Your traces should contain incoming packets (negative direction_size) and outgoing packets (positive direction_size)",
+        )
+    if utility.med_time == 0:
+        return (
+            False,
+            "The median duration of your traces should not be null",
+        )
+    if abs(utility.med_in_volume * utility.med_out_volume * utility.med_time) == 1:
+        return (
+            False,
+            "The product of the median volumes and duration of your traces should not be 1, your utility score cannot be computed",
+        )
+    # every capture is padded to the longest one in the feature matrices, which must fit in the memory of a worker
+    longest_capture = summary["nb_packets"].max()
+    if len(summary) * longest_capture > MAX_FEATURE_CELLS:
+        return (
+            False,
+            f"Your longest trace contains {longest_capture} packets, with {len(summary)} captures your traces should contain at most {MAX_FEATURE_CELLS // len(summary)} packets",
+        )
     return True, ""
 
 
-def evaluate_utility(df: DataFrame) -> Utility:
+def evaluate_utility(summary: DataFrame) -> Utility:
     """Evaluates the utility metric of the trace uploaded by the user. This evaluation depends on the application and here is only valid in the context of network fingerprinting.
 
     Args:
-        df: the dataframe containing the data uploaded by the users. Expected to have columns 'direction_size' and 'timestamp'
+        summary: the per capture summary of the data uploaded by the users
 
     Returns:
         utility: the Utility object holding the results
     """
-    in_volume_grouped_by = (
-        df[df["direction_size"] < 0]
-        .groupby([CLASS_NAME, REP_NAME])["direction_size"]
-        .sum()
-    )
-    out_volume_grouped_by = (
-        df[df["direction_size"] > 0]
-        .groupby([CLASS_NAME, REP_NAME])["direction_size"]
-        .sum()
-    )
-    comm_time_grouped_by = df.groupby([CLASS_NAME, REP_NAME])["timestamp"].max()
+    # volumes are sums of strictly negative (resp. positive) sizes: a null volume means the capture has no packet in this direction and is not accounted for
+    in_volume = summary["in_volume"][summary["in_volume"] < 0]
+    out_volume = summary["out_volume"][summary["out_volume"] > 0]
+    comm_time = summary["duration"]
     return Utility(
-        in_volume_grouped_by.max(),
-        in_volume_grouped_by.mean(),
-        in_volume_grouped_by.median(),
-        out_volume_grouped_by.max(),
-        out_volume_grouped_by.mean(),
-        out_volume_grouped_by.median(),
-        comm_time_grouped_by.max(),
-        comm_time_grouped_by.mean(),
-        comm_time_grouped_by.median(),
+        in_volume.max(),
+        in_volume.mean(),
+        in_volume.median(),
+        out_volume.max(),
+        out_volume.mean(),
+        out_volume.median(),
+        comm_time.max(),
+        comm_time.mean(),
+        comm_time.median(),
     )
 
 
-def randomize_rep_index(df: DataFrame) -> list[int]:
+def random_labels(nb_labels: int) -> np.ndarray:
+    """Draws distinct random labels from the operating system's CSPRNG. Used as a secret permutation of capture codes: a label says nothing about the capture it is given to.
+
+    Args:
+        nb_labels: the number of labels to draw
+
+    Returns:
+        labels: array of nb_labels distinct labels below 2^24
+    """
+    # random is only 3 bytes number, there should be way less than 2^12 captures which keeps redraws rare
+    labels = np.frombuffer(os.urandom(4 * nb_labels), dtype=np.uint32) >> 8
+    labels = labels.astype(np.int32)
+    while True:
+        # we redraw the colliding labels, two captures must never be merged under the same label
+        _, first_occurrences = np.unique(labels, return_index=True)
+        if len(first_occurrences) == nb_labels:
+            return labels
+        collisions = np.ones(nb_labels, dtype=bool)
+        collisions[first_occurrences] = False
+        labels[collisions] = (
+            np.frombuffer(os.urandom(4 * collisions.sum()), dtype=np.uint32) >> 8
+        )
+
+
+def capture_codes(df: DataFrame) -> np.ndarray:
+    """Numbers the captures of the uploaded dataset.
+
+    Args:
+        df: the dataframe containing the data uploaded by the users
+
+    Returns:
+        codes: for each row, the index in [0, number of captures) of the (class_id, rep) pair it belongs to
+    """
+    return df.groupby([CLASS_NAME, REP_NAME], sort=False).ngroup().to_numpy()
+
+
+def randomize_rep_index(df: DataFrame) -> np.ndarray:
     """Utility method that aims at giving new labels to the repetition column of the uploaded dataset to break relationship between train and test sets repetition labels while preserving the relation between rows belonging to a same capture. This allows to safely give train and test set while not leaking information on test set's labels from the repetition index.
 
     Args:
         df: the dataframe containing the data uploaded by the users
 
     Returns:
-        rep_to_rnd: the list of new indexes to replace the previous repetition column
+        rep_to_rnd: the array of new indexes to replace the previous repetition column
     """
-    # random 'salt', unique for a run but changes between runs
-    rnd = secrets.randbits(128)
-    # precomputes the mapping from class_id, rep to its new random label
-    # for efficiency as we expect a lot of redundancy
-    # random is only 3 bytes number, there should be way less than 2^12 pairs which reduces collision proba
-    class_rep_pair_to_rnd = {
-        (class_id, rep): int.from_bytes(
-            sha256("{}{}{}".format(rnd, class_id, rep).encode()).digest()[:3],
-            byteorder=sys.byteorder,
-        )
-        for class_id, rep in df[[CLASS_NAME, REP_NAME]].drop_duplicates().values
-    }
-    return [
-        class_rep_pair_to_rnd[(cell_id, rep)]
-        for cell_id, rep in df[[CLASS_NAME, REP_NAME]].values
-    ]
+    codes = capture_codes(df)
+    # each row gathers the label drawn for its capture
+    return random_labels(codes.max() + 1)[codes]
 
 
 def split_train_test_set(df: DataFrame) -> tuple[DataFrame, DataFrame, DataFrame]:
@@ -134,52 +297,128 @@ def split_train_test_set(df: DataFrame) -> tuple[DataFrame, DataFrame, DataFrame
         verification_set: dataframe containing the true label for each repetition id of the test set
         train_set: the features and corresponding labels to train a model on
     """
-    # we recreate rep indexes to avoid identification of the repetitions that are missing in the trainset and therefore are in the test set, making classification way easier.
-    df[REP_NAME] = randomize_rep_index(df)
+    # the selection is made on capture codes, rows are only gathered once at the end
+    codes = capture_codes(df)
+    nb_captures = codes.max() + 1
+    classes = df[CLASS_NAME].to_numpy()
+    capture_class = np.empty(nb_captures, dtype=classes.dtype)
+    capture_class[codes] = classes
 
-    # takes class name and rep name pair making sure each class_name is included once
-    sub_test_set_all_cell_id = (
-        df[[CLASS_NAME, REP_NAME]].groupby(CLASS_NAME).first().reset_index()
-    )
-    # identifies the already selected class, rep pair's indexes in the original dataframe
-    indexes_to_drop = df[[CLASS_NAME, REP_NAME]].merge(sub_test_set_all_cell_id).index
-    # selects the remaining class, rep pairs of the test set by sampling NB_TRACES_TO_CLASSIFY - NB_CLASSES captures randomly. The full test set is the concatenation of both
-    test_set_cellid_rep = pd.concat(
-        [
-            df[[CLASS_NAME, REP_NAME]]
-            .drop(index=indexes_to_drop)
-            .drop_duplicates()
-            .sample(app.config["NB_TRACES_TO_CLASSIFY"] - df[CLASS_NAME].nunique()),
-            sub_test_set_all_cell_id,
-        ]
-    )
-    # selects the rows from original dataframe by their class, rep pair
-    test_set_rows = df.merge(test_set_cellid_rep)
-    # creates the capture_id column by randomizing again the repetition's
-    test_set_rows[CAPTURE_NAME] = randomize_rep_index(test_set_rows)
+    # we go through captures in a random order: the first capture met for each class makes sure every class is in the test set, the next ones are a random sample completing the test set up to NB_TRACES_TO_CLASSIFY captures
+    order = np.random.default_rng().permutation(nb_captures)
+    _, first_of_class = np.unique(capture_class[order], return_index=True)
+    in_test_set = np.zeros(nb_captures, dtype=bool)
+    in_test_set[order[first_of_class]] = True
+    nb_to_sample = max(app.config["NB_TRACES_TO_CLASSIFY"] - len(first_of_class), 0)
+    in_test_set[order[~in_test_set[order]][:nb_to_sample]] = True
 
-    test_set = test_set_rows[[CAPTURE_NAME, "direction_size", "timestamp"]].sort_values(
-        by=[CAPTURE_NAME, "timestamp"]
-    )
+    # we recreate rep indexes to avoid identification of the repetitions that are missing in the trainset and therefore are in the test set, making classification way easier. The capture_id labels of the test set are drawn independently
+    rep_labels = random_labels(nb_captures)
+    capture_id_labels = random_labels(nb_captures)
 
-    verification_set = (
-        test_set_rows[[CAPTURE_NAME, CLASS_NAME]]
-        .drop_duplicates()
-        .sort_values(by=[CAPTURE_NAME])
+    is_test_row = in_test_set[codes]
+    test_rows = np.flatnonzero(is_test_row)
+    train_rows = np.flatnonzero(~is_test_row)
+
+    test_capture_ids = capture_id_labels[codes[test_rows]]
+    test_rows = test_rows[
+        np.lexsort((df["timestamp"].to_numpy()[test_rows], test_capture_ids))
+    ]
+    test_set = df[["direction_size", "timestamp"]].take(test_rows)
+    test_set.insert(0, CAPTURE_NAME, capture_id_labels[codes[test_rows]])
+
+    test_captures = np.flatnonzero(in_test_set)
+    test_captures = test_captures[np.argsort(capture_id_labels[test_captures])]
+    verification_set = DataFrame(
+        {
+            CAPTURE_NAME: capture_id_labels[test_captures],
+            CLASS_NAME: capture_class[test_captures],
+        }
     )
 
-    train_set = df.drop(index=test_set_rows.index).sort_values(by=["cell_id", "rep"])
+    # the sort is stable, rows of a capture keep their order
+    train_rows = train_rows[
+        np.lexsort((rep_labels[codes[train_rows]], classes[train_rows]))
+    ]
+    train_set = df.take(train_rows)
+    train_set[REP_NAME] = rep_labels[codes[train_rows]]
 
     return [test_set, verification_set, train_set]
 
 
+def segment_starts(*keys: np.ndarray) -> np.ndarray:
+    """Returns the index of the first row of each run of consecutive rows with the same keys"""
+    if len(keys[0]) == 0:
+        return np.empty(0, dtype=np.int64)
+    changes = np.zeros(len(keys[0]), dtype=bool)
+    changes[0] = True
+    for key in keys:
+        changes[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(changes)
+
+
+def padded_matrix(values: np.ndarray, starts: np.ndarray, width: int) -> np.ndarray:
+    """Lays out consecutive segments of values as the rows of a matrix, padded with zeros.
+
+    Args:
+        values: the concatenated segments
+        starts: the index in values of the first value of each segment
+        width: the number of columns of the matrix, at least the length of the longest segment
+
+    Returns:
+        matrix: the (len(starts), width) matrix whose row i starts with the segment i
+    """
+    lengths = np.diff(np.append(starts, len(values)))
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    columns = np.arange(len(values)) - np.repeat(starts, lengths)
+    matrix = np.zeros((len(starts), width), dtype=values.dtype)
+    matrix[rows, columns] = values
+    return matrix
+
+
+def feature_matrices(
+    test_set: DataFrame, train_set: DataFrame
+) -> dict[str, np.ndarray]:
+    """Builds the padded matrices of the packets of each capture of the test and train sets as split by split_train_test_set, the features the students would otherwise build from the csv files. The captures of the test set are in the order of their capture id, the one of the verification set.
+
+    Args:
+        test_set: the test set, its rows sorted by capture id
+        train_set: the train set, the rows of a capture consecutive
+
+    Returns:
+        features: the arrays test_capture_ids and train_labels, the capture id or class of each capture, test_lengths and train_lengths, its number of packets, and the direction_size and timestamp matrices of each set, one row per capture padded with zeros to the longest capture of both sets
+    """
+    test_starts = segment_starts(test_set[CAPTURE_NAME].to_numpy())
+    train_starts = segment_starts(
+        train_set[CLASS_NAME].to_numpy(), train_set[REP_NAME].to_numpy()
+    )
+    test_lengths = np.diff(np.append(test_starts, len(test_set))).astype(np.int32)
+    train_lengths = np.diff(np.append(train_starts, len(train_set))).astype(np.int32)
+    width = max(test_lengths.max(initial=0), train_lengths.max(initial=0))
+    features = {
+        "test_capture_ids": test_set[CAPTURE_NAME].to_numpy()[test_starts],
+        "test_lengths": test_lengths,
+        "train_labels": train_set[CLASS_NAME].to_numpy()[train_starts],
+        "train_lengths": train_lengths,
+    }
+    for column in ["direction_size", "timestamp"]:
+        features["test_" + column] = padded_matrix(
+            test_set[column].to_numpy(), test_starts, width
+        )
+        features["train_" + column] = padded_matrix(
+            train_set[column].to_numpy(), train_starts, width
+        )
+    return features
+
+
 @celery.task
-def treat_uploaded_defence(filename: str, user_id: int) -> None:
+def treat_uploaded_defence(filename: str, user_id: int, digest: str = None) -> None:
     """Deals with a file uploaded for defence from its verification to the creation of associated test, train and verification sets. Made to be triggered asynchronously and handled by a celery worker. Once done, the 3 sets are saved in separate compressed files and the Defence resulting is pushed in the database. Depends on the application and here is only valid in the context of network fingerprinting.
 
     Args:
         filename: the filename of the file uploaded by user and saved in the temporary upload folder
         user_id: the id of the user we are evaluating the defence of (passing user_id is easier to pass than User object as the arguments are serialized and sent to the celery workers)
+        digest: the sha256 digest of the uploaded file, stored to recognize identical uploads
 
     """
     # The task is called only if the user had a team
@@ -194,35 +433,44 @@ def treat_uploaded_defence(filename: str, user_id: int) -> None:
     )
     error_msg = ""
     try:
-        df = pd.read_csv(filepath)
-        ok_df, error_msg = verify_dataframe(df)
+        # the checks and the utility only need per capture aggregates: we stream the file to keep the memory bounded and only load it fully once it is known to be valid
+        ok_df, error_msg = verify_columns(read_csv_header(filepath))
         if ok_df:
-            utility = evaluate_utility(df)
+            try:
+                summary = stream_capture_summary(filepath)
+            except ValueError:
+                ok_df, error_msg = (
+                    False,
+                    "Your dataset contains values of the wrong type: cell_id, rep and direction_size should be integers, timestamp a number",
+                )
+            else:
+                ok_df, error_msg = verify_dataframe(summary)
+        if ok_df:
+            utility = evaluate_utility(summary)
+            df = read_csv(filepath)
             defence = Defence(
                 defender_team_id=team.id,
                 utility=utility,
                 round=app.config["ROUND"],
+                digest=digest,
             )
             datasets = split_train_test_set(df)
-            # we save the file to the upload folder
-            for fname_format, dataframe in zip(
-                [
-                    "TEST_FILENAME_FORMAT",
-                    "VERIF_FILENAME_FORMAT",
-                    "TRAIN_FILENAME_FORMAT",
-                ],
-                datasets,
-            ):
-                dataset_filename = os.path.join(
-                    app.root_path,
-                    app.config["UPLOAD_FOLDER"],
-                    app.config[fname_format].format(team.id),
-                )
-                # we must take care of removing the indexes in case this could reveal the split
-                dataframe.to_csv(dataset_filename, index=False)
+            # the students download the features they would build from the test and train sets. Built before any file is replaced: a failure leaves the previous defence whole
+            features = feature_matrices(datasets[0], datasets[2])
+            # we save the files to the upload folder
+            for kind, dataframe in zip(["test", "verif", "train"], datasets):
+                save_dataset(dataframe, kind, team.id)
+            save_features(features, team.id)
 
             db.session.add(defence)
+            # the team's scores are updated in the same transaction as its defence
+            TeamRoundScore.refresh(app.config["ROUND"], [team.id])
             db.session.commit()
+            CachedLeaderboard.invalidate(app.config["ROUND"])
+            # the attacks against this team are now evaluated against the new verification set
+            refresh_answer_key(app.config["ROUND"])
+            # the teams attacking this team download its new sets
+            build_attack_bundles.delay(app.config["ROUND"], team.id)
             send_mail.delay(
                 "Your upload for Secret Race Strolling succeeded",
                 [member1.email, member2.email],
@@ -1,10 +1,32 @@
 import numpy as np
 import pandas as pd
+import os
 import random as rd
 from sklearn.ensemble import RandomForestClassifier
 
 import sys
 
+# explicit compact types of the provided datasets' columns, instead of the 64 bits types pandas infers
+DTYPES = {
+    "cell_id": np.int16,
+    "rep": np.int32,
+    "capture_id": np.int32,
+    "direction_size": np.int32,
+    "timestamp": np.float32,
+}
+try:
+    import pyarrow
+
+    # multithreaded parser, faster than the default one
+    ENGINE = "pyarrow"
+except ImportError:
+    ENGINE = "c"
+
+
+def read_csv(filepath: str) -> pd.DataFrame:
+    df = pd.read_csv(filepath, engine=ENGINE)
+    return df.astype({col: dtype for col, dtype in DTYPES.items() if col in df.columns})
+
 
 def classify(train_features, train_labels, test_features, test_labels):
     # Initialize a random forest classifier. We prefer to use all the jobs our processor can handle, we are people in a hurry
@@ -20,24 +42,32 @@ def classify(train_features, train_labels, test_features, test_labels):
 
 
 def load_data(attacked_team_id: str):
+    # the padded features published with the sets spare building them from the csv files
+    features_path = f"team_{attacked_team_id}_features.npz"
+    if os.path.exists(features_path):
+        with np.load(features_path) as features:
+            return (
+                features["test_direction_size"],
+                features["train_direction_size"],
+                features["train_labels"],
+                features["test_capture_ids"],
+            )
+
+    test = read_csv(f"team_{attacked_team_id}_test.csv.zip")
     features_test = np.array(
-        pd.read_csv(f"team_{attacked_team_id}_test.csv.zip")
-        .groupby(["capture_id"])["direction_size"]
+        test.groupby(["capture_id"])["direction_size"]
         .apply(np.array)
         .reset_index()["direction_size"]
     )
+    capture_ids = test["capture_id"].drop_duplicates().to_numpy()
 
+    train = read_csv(f"team_{attacked_team_id}_train.csv.zip")
     features_train = np.array(
-        pd.read_csv(f"team_{attacked_team_id}_train.csv.zip")
-        .groupby(["cell_id", "rep"])["direction_size"]
+        train.groupby(["cell_id", "rep"])["direction_size"]
         .apply(np.array)
         .reset_index()["direction_size"]
     )
-    labels_train = (
-        pd.read_csv(f"team_{attacked_team_id}_train.csv.zip")[["cell_id", "rep"]]
-        .drop_duplicates()["cell_id"]
-        .to_numpy()
-    )
+    labels_train = train[["cell_id", "rep"]].drop_duplicates()["cell_id"].to_numpy()
 
     max_len = max([len(a) for a in features_train] + [len(b) for b in features_test])
     Z_train = np.zeros((len(features_train), max_len))
@@ -48,11 +78,11 @@ def load_data(attacked_team_id: str):
     for enu, row in enumerate(features_test):
         Z_test[enu, : len(row)] = row
 
-    return Z_test, Z_train, labels_train
+    return Z_test, Z_train, labels_train, capture_ids
 
 
 def main(team_id: str):
-    Z_test, Z_train, labels_train = load_data(team_id)
+    Z_test, Z_train, labels_train, capture_ids = load_data(team_id)
     _, predictions_proba = classify(Z_train, labels_train, Z_test, None)
 
     # for row in predictions_proba:
@@ -63,12 +93,7 @@ def main(team_id: str):
         index=None,
         columns=["proba_class_{}".format(i) for i in range(1, 101)],
     )
-    capture_id_indexes = (
-        pd.read_csv(f"team_{team_id}_test.csv.zip")["capture_id"]
-        .drop_duplicates()
-        .to_list()
-    )
-    df.insert(loc=0, column="capture_id", value=capture_id_indexes)
+    df.insert(loc=0, column="capture_id", value=capture_ids)
     df.insert(
         loc=0,
         column="team_id",
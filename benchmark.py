@@ -0,0 +1,265 @@
+"""Benchmarks of the hot paths of the defence and attack evaluation and of the match generation against their former implementations. Run with `python3 benchmark.py [--rows N] [--repeat R]`."""
+
+import argparse
+import secrets
+import sys
+import time
+import timeit
+import tracemalloc
+from hashlib import sha256
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from sklearn.metrics import roc_auc_score
+from sqlalchemy import create_engine, insert
+
+from app import app, db
+from app.matchmaking import pair_teams
+from app.metrics import one_vs_rest_roc_auc
+from app.models import Match
+from app.tasks_defence import (
+    CAPTURE_NAME,
+    CLASS_NAME,
+    REP_NAME,
+    randomize_rep_index,
+    split_train_test_set,
+)
+
+
+def synthetic_trace(nb_rows: int, seed: int = 0) -> DataFrame:
+    """Generates a defence dataset of about nb_rows rows, with MEAN_NB_REP_PER_CLASS captures of equal length for each class"""
+    rng = np.random.default_rng(seed)
+    nb_captures = app.config["NB_CLASSES"] * app.config["MEAN_NB_REP_PER_CLASS"]
+    rows_per_capture = max(nb_rows // nb_captures, app.config["ROWS_PER_CAPTURE"] + 1)
+    nb_rows = nb_captures * rows_per_capture
+    sizes = rng.integers(1, 1500, nb_rows)
+    return DataFrame(
+        {
+            CLASS_NAME: np.repeat(
+                np.arange(1, app.config["NB_CLASSES"] + 1),
+                app.config["MEAN_NB_REP_PER_CLASS"] * rows_per_capture,
+            ),
+            REP_NAME: np.tile(
+                np.repeat(
+                    np.arange(app.config["MEAN_NB_REP_PER_CLASS"]), rows_per_capture
+                ),
+                app.config["NB_CLASSES"],
+            ),
+            "direction_size": np.where(rng.random(nb_rows) < 0.5, -sizes, sizes),
+            "timestamp": np.tile(np.arange(rows_per_capture) * 0.01, nb_captures),
+        }
+    )
+
+
+def legacy_randomize_rep_index(df: DataFrame) -> list[int]:
+    """Former implementation of randomize_rep_index, hashing each pair and relabeling row by row"""
+    rnd = secrets.randbits(128)
+    class_rep_pair_to_rnd = {
+        (class_id, rep): int.from_bytes(
+            sha256("{}{}{}".format(rnd, class_id, rep).encode()).digest()[:3],
+            byteorder=sys.byteorder,
+        )
+        for class_id, rep in df[[CLASS_NAME, REP_NAME]].drop_duplicates().values
+    }
+    return [
+        class_rep_pair_to_rnd[(cell_id, rep)]
+        for cell_id, rep in df[[CLASS_NAME, REP_NAME]].values
+    ]
+
+
+def legacy_split_train_test_set(df: DataFrame) -> list[DataFrame]:
+    """Former implementation of split_train_test_set, selecting the test captures with merges"""
+    df = df.copy()
+    df[REP_NAME] = legacy_randomize_rep_index(df)
+    sub_test_set_all_cell_id = (
+        df[[CLASS_NAME, REP_NAME]].groupby(CLASS_NAME).first().reset_index()
+    )
+    indexes_to_drop = df[[CLASS_NAME, REP_NAME]].merge(sub_test_set_all_cell_id).index
+    test_set_cellid_rep = pd.concat(
+        [
+            df[[CLASS_NAME, REP_NAME]]
+            .drop(index=indexes_to_drop)
+            .drop_duplicates()
+            .sample(app.config["NB_TRACES_TO_CLASSIFY"] - df[CLASS_NAME].nunique()),
+            sub_test_set_all_cell_id,
+        ]
+    )
+    test_set_rows = df.merge(test_set_cellid_rep)
+    test_set_rows[CAPTURE_NAME] = legacy_randomize_rep_index(test_set_rows)
+    test_set = test_set_rows[[CAPTURE_NAME, "direction_size", "timestamp"]].sort_values(
+        by=[CAPTURE_NAME, "timestamp"]
+    )
+    verification_set = (
+        test_set_rows[[CAPTURE_NAME, CLASS_NAME]]
+        .drop_duplicates()
+        .sort_values(by=[CAPTURE_NAME])
+    )
+    train_set = df.drop(index=test_set_rows.index).sort_values(
+        by=[CLASS_NAME, REP_NAME]
+    )
+    return [test_set, verification_set, train_set]
+
+
+def measure(func, *args) -> tuple[float, int]:
+    """Returns the duration and the peak of memory allocated while running func"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+
+def report(name: str, legacy: float, current: float) -> None:
+    print(
+        "{:<28s} legacy: {:9.4f}s   current: {:9.4f}s   speedup: {:7.1f}x".format(
+            name, legacy, current, legacy / current
+        )
+    )
+
+
+def bench_randomize_rep_index(df: DataFrame, repeat: int) -> None:
+    # both must keep rows of a same capture together and separate different captures
+    nb_captures = len(df[[CLASS_NAME, REP_NAME]].drop_duplicates())
+    assert len(np.unique(randomize_rep_index(df))) == nb_captures
+    legacy = min(
+        timeit.repeat(lambda: legacy_randomize_rep_index(df), number=1, repeat=repeat)
+    )
+    current = min(
+        timeit.repeat(lambda: randomize_rep_index(df), number=1, repeat=repeat)
+    )
+    report("randomize_rep_index", legacy, current)
+
+
+def bench_split_train_test_set(df: DataFrame) -> None:
+    input_size = df.memory_usage(index=True).sum()
+    legacy, legacy_peak = measure(legacy_split_train_test_set, df)
+    current, current_peak = measure(split_train_test_set, df)
+    report("split_train_test_set", legacy, current)
+    print(
+        "{:<28s} legacy: {:8.0f}MB   current: {:8.0f}MB   (input: {:.0f}MB)".format(
+            "  peak memory",
+            legacy_peak / 2**20,
+            current_peak / 2**20,
+            input_size / 2**20,
+        )
+    )
+
+
+def bench_roc_auc(repeat: int) -> None:
+    rng = np.random.default_rng(0)
+    for nb_classes in [10, 100, 1000]:
+        for nb_captures in [app.config["NB_TRACES_TO_CLASSIFY"], 10000, 100000]:
+            # the largest matrices would not fit in memory
+            if nb_captures < nb_classes or nb_captures * nb_classes > 10**7:
+                continue
+            classes = np.arange(1, nb_classes + 1)
+            labels = np.concatenate(
+                (classes, rng.integers(1, nb_classes + 1, nb_captures - nb_classes))
+            )
+            proba = rng.random((nb_captures, nb_classes))
+            proba /= proba.sum(axis=1, keepdims=True)
+            # the in-house area must be the one of sklearn
+            assert (
+                abs(
+                    one_vs_rest_roc_auc(labels, proba, classes)
+                    - roc_auc_score(labels, proba, multi_class="ovr", labels=classes)
+                )
+                <= 1e-9
+            )
+            legacy = min(
+                timeit.repeat(
+                    lambda: roc_auc_score(
+                        labels, proba, multi_class="ovr", labels=classes
+                    ),
+                    number=1,
+                    repeat=repeat,
+                )
+            )
+            current = min(
+                timeit.repeat(
+                    lambda: one_vs_rest_roc_auc(labels, proba, classes),
+                    number=1,
+                    repeat=repeat,
+                )
+            )
+            report("roc_auc {:d}x{:d}".format(nb_captures, nb_classes), legacy, current)
+
+
+def legacy_pair_teams(team_ids: np.ndarray, matches_per_team: int) -> np.ndarray:
+    """The former rotation of generate_matches: a single random order, each team attacking the next ones"""
+    order = np.random.default_rng().permutation(team_ids)
+    pairs = []
+    for team_index in range(len(order)):
+        for match_index in range(1, matches_per_team + 1):
+            pairs.append(
+                (order[team_index], order[(team_index + match_index) % len(order)])
+            )
+    return np.array(pairs, dtype=np.int64)
+
+
+def bench_matchmaking(nb_rounds: int) -> None:
+    matches_per_team = app.config["MATCHES_PER_TEAM"]
+    for nb_teams in [1000, 5000, 20000]:
+        team_ids = np.arange(1, nb_teams + 1)
+        legacy_pairs = np.empty((0, 2), dtype=np.int64)
+        past_pairs = np.empty((0, 2), dtype=np.int64)
+        legacy = current = 0.0
+        # the generation of the last round, with the most past matches, is timed
+        for _ in range(nb_rounds):
+            start = time.perf_counter()
+            round_pairs = legacy_pair_teams(team_ids, matches_per_team)
+            legacy = time.perf_counter() - start
+            legacy_pairs = np.concatenate((legacy_pairs, round_pairs))
+            start = time.perf_counter()
+            round_pairs = pair_teams(
+                team_ids,
+                matches_per_team,
+                past_pairs,
+                app.config["MATCHMAKING_SHUFFLES"],
+                seed=1,
+            )
+            current = time.perf_counter() - start
+            past_pairs = np.concatenate((past_pairs, round_pairs))
+        report("pair_teams {:d} teams".format(nb_teams), legacy, current)
+        print(
+            "{:<28s} legacy: {:8d}     current: {:8d}     (after {:d} rounds)".format(
+                "  repeated matches",
+                len(legacy_pairs) - len(np.unique(legacy_pairs, axis=0)),
+                len(past_pairs) - len(np.unique(past_pairs, axis=0)),
+                nb_rounds,
+            )
+        )
+        # the bulk insertion of the matches of a round, in an in-memory database
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(
+                insert(Match),
+                [
+                    {"attacker_team_id": a, "defender_team_id": d, "round": 1}
+                    for a, d in round_pairs.tolist()
+                ],
+            )
+        print(
+            "{:<28s} {:9.4f}s for {:d} matches".format(
+                "  bulk insert", time.perf_counter() - start, len(round_pairs)
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = synthetic_trace(args.rows)
+    print("Synthetic trace of {:,d} rows".format(len(df)))
+    bench_randomize_rep_index(df, args.repeat)
+    bench_split_train_test_set(df)
+    bench_roc_auc(args.repeat)
+    bench_matchmaking(nb_rounds=5)
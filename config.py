@@ -29,6 +29,18 @@ class Config(object):
     TEMPORARY_UPLOAD_FOLDER = (
         os.environ.get("TEMPORARY_UPLOAD_FOLDER") or "temp_uploads"
     )
+    VERIFICATION_CACHE_SIZE = int(
+        os.environ.get("VERIFICATION_CACHE_SIZE") or 64
+    )  # number of verification sets kept in memory by each worker process
+    IDENTITY_CACHE_TIME = int(
+        os.environ.get("IDENTITY_CACHE_TIME") or 0
+    )  # in seconds, time a web process keeps the logged in users and their team in memory, 0 to load them at every request
+    QUERY_BUDGET = int(
+        os.environ.get("QUERY_BUDGET") or 20
+    )  # number of SQL queries above which a request or a task is logged as a warning
+    QUERY_STATS_HEADERS = (
+        os.environ.get("QUERY_STATS_HEADERS") is not None
+    )  # sends the number of SQL queries and their duration in the X-Query-Count and X-Query-Time headers of the responses
 
     """
     ###################
@@ -63,6 +75,12 @@ class Config(object):
     """
 
     MATCHES_PER_TEAM = int(os.environ.get("MATCHES_PER_TEAM") or 3)
+    MATCHMAKING_SHUFFLES = int(
+        os.environ.get("MATCHMAKING_SHUFFLES") or 32
+    )  # number of random orders of the teams tried to avoid repeating the matches of the previous rounds
+    MATCHMAKING_SEED = int(
+        os.environ.get("MATCHMAKING_SEED") or 0
+    )  # seed of the order of the teams on the circle, kept from round to round
     DEFENCE_PHASE = True  # for development, should be set to False at startup. Expected to be modifiable at runtime
     ATTACK_PHASE = True  # Expected to be modifiable at runtime
     ROUND = 1  # Expected to be modifiable at runtime
@@ -81,6 +99,12 @@ class Config(object):
     MEAN_NB_REP_PER_CLASS = int(os.environ.get("MEAN_NB_REP_PER_CLASS") or 32)
     DEVIATION_NB_REP_PER_CLASS = int(os.environ.get("DEVIATION_NB_REP_PER_CLASS") or 7)
     ROWS_PER_CAPTURE = int(os.environ.get("ROWS_PER_CAPTURE") or 5)
+    DEFENCE_CHUNK_SIZE = int(
+        os.environ.get("DEFENCE_CHUNK_SIZE") or 1000000
+    )  # in rows, number of rows of the uploaded defence held in memory at once during verification
+    MAX_FEATURE_CELLS = int(
+        os.environ.get("MAX_FEATURE_CELLS") or 25000000
+    )  # number of captures times the number of packets of the longest capture, bounds the size of the padded feature matrices
 
     """
     ###################
@@ -91,6 +115,15 @@ class Config(object):
     LEADERBOARD_CACHE_TIME = int(
         os.environ.get("LEADERBOARD_CACHE_TIME") or 5
     )  # in seconds
+    LEADERBOARD_REDIS_URL = (
+        os.environ.get("LEADERBOARD_REDIS_URL") or CELERY_BROKER_URL
+    )  # Redis instance sharing the cached leaderboard between the processes
+    LEADERBOARD_LOCK_TIME = int(
+        os.environ.get("LEADERBOARD_LOCK_TIME") or 30
+    )  # in seconds, longest time a process may hold the right to recompute the leaderboard
+    LEADERBOARD_WAIT_TIME = float(
+        os.environ.get("LEADERBOARD_WAIT_TIME") or 2
+    )  # in seconds, longest time a request waits for another process computing the first leaderboard
 
     """
     ###################
@@ -129,3 +162,10 @@ class Config(object):
     TEST_FILENAME_FORMAT = "team_{}_test.csv.zip"
     TRAIN_FILENAME_FORMAT = "team_{}_train.csv.zip"
     VERIF_FILENAME_FORMAT = "team_{}_verif.csv.zip"
+    FEATURES_FILENAME_FORMAT = "team_{}_features.npz"  # padded feature matrices of the test and train sets, downloaded with them
+    TEST_ARROW_FILENAME_FORMAT = "team_{}_test.arrow"  # typed copies of the above sets, read by the server when pyarrow is installed
+    TRAIN_ARROW_FILENAME_FORMAT = "team_{}_train.arrow"
+    VERIF_ARROW_FILENAME_FORMAT = "team_{}_verif.arrow"
+    ANSWER_KEY_FILENAME_FORMAT = "round_{}_answer_key.npz"  # arrays of a round the attacks are evaluated against, only read by the server
+    BUNDLE_FILENAME_FORMAT = "team_{}_round_{}_sets_to_attack_{}.zip"  # sets a team downloads to attack in a round, by version
+    MANIFEST_FILENAME_FORMAT = "team_{}_round_{}_manifest_{}.json"  # digests of the sets in each version of the above bundles
@@ -1,8 +1,11 @@
 from app import db, app
-from app.models import Attack, Defence, Match, Team, User
+from app.models import Attack, Defence, Match, Team, TeamRoundScore, User
 
 
 def flush_matches():
+    for s in TeamRoundScore.query.all():
+        db.session.delete(s)
+    db.session.commit()
     for a in Attack.query.all():
         db.session.delete(a)
     db.session.commit()
@@ -25,6 +28,15 @@ def flush_whole_db():
     db.session.commit()
 
 
+def rebuild_scores():
+    """Recomputes the stored scores of every team in every round from the defence and attack history, e.g. after the scores table was created"""
+    rounds = {r for r, in db.session.query(Match.round).distinct()}
+    rounds |= {r for r, in db.session.query(Defence.round).distinct()}
+    for round in sorted(rounds):
+        TeamRoundScore.refresh(round)
+    db.session.commit()
+
+
 def populate_test_users():
     flush_whole_db()
     for i, u_name in enumerate(
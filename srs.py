@@ -1,9 +1,9 @@
 from app import app, db
-from app.models import Attack, Defence, Match, Team, User
+from app.models import Attack, Defence, Match, Team, TeamRoundScore, User
 from app.tasks_attack import treat_uploaded_attack
 from app.tasks_defence import treat_uploaded_defence
 from app.tasks_control import send_mail
-from db_scripts import populate_test_users
+from db_scripts import populate_test_users, rebuild_scores
 
 
 @app.shell_context_processor
@@ -15,8 +15,10 @@ def make_shell_context():
         "Defence": Defence,
         "Match": Match,
         "Attack": Attack,
+        "TeamRoundScore": TeamRoundScore,
         "treat_uploaded_defence": treat_uploaded_defence,
         "treat_uploaded_attack": treat_uploaded_attack,
         "send_mail": send_mail,
         "populate_test_users": populate_test_users,
+        "rebuild_scores": rebuild_scores,
     }
@@ -1,7 +1,227 @@
+import os
+import tempfile
+import time
 import unittest
+import unittest.mock
+from io import BytesIO
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+import redis
+from sklearn.metrics import roc_auc_score
+from sqlalchemy import event
 
 from app import app, db
+from app.answer_keys import load_answer_key
+from app.bundles import build_bundle, build_round_bundles, bundle_path
+from app.cached_items import (
+    RELEASE_LOCK_SCRIPT,
+    STORE_ITEMS_SCRIPT,
+    CachedLeaderboard,
+)
+from app.datasets import (
+    UMASK,
+    dataset_path,
+    enforce_schema,
+    load_dataset,
+    load_verification_set,
+    read_csv,
+    read_csv_header,
+    save_dataset,
+)
+from app.matchmaking import generate_round_matches, pair_teams
+from app.metrics import one_vs_rest_roc_auc
 from app.models import *
+from app.tasks_attack import evaluate_attack_perf, verify_attack
+from app.tasks_defence import (
+    evaluate_utility,
+    feature_matrices,
+    randomize_rep_index,
+    split_train_test_set,
+    stream_capture_summary,
+    summarize_captures,
+    verify_dataframe,
+)
+
+
+def fake_defence_dataframe(nb_rep: int = 32, nb_rows: int = 10, seed: int = 0):
+    """Generates a defence dataset with every class, nb_rep captures per class and nb_rows packets per capture"""
+    rng = np.random.default_rng(seed)
+    nb_captures = app.config["NB_CLASSES"] * nb_rep
+    sizes = rng.integers(1, 1500, nb_captures * nb_rows)
+    return pd.DataFrame(
+        {
+            "cell_id": np.repeat(
+                np.arange(1, app.config["NB_CLASSES"] + 1), nb_rep * nb_rows
+            ),
+            "rep": np.tile(
+                np.repeat(np.arange(nb_rep), nb_rows), app.config["NB_CLASSES"]
+            ),
+            "direction_size": np.where(rng.random(sizes.size) < 0.5, -sizes, sizes),
+            "timestamp": np.tile(np.arange(nb_rows) * 0.1, nb_captures)
+            + rng.random(nb_captures * nb_rows),
+        }
+    )
+
+
+def fake_attack_dataframe(attacked_ids: list[int], seed: int = 0):
+    """Saves a verification set for each attacked team and generates an attack against them, with shuffled rows and columns"""
+    rng = np.random.default_rng(seed)
+    nb_classes = app.config["NB_CLASSES"]
+    nb_traces = app.config["NB_TRACES_TO_CLASSIFY"]
+    attacks = []
+    for attacked_id in attacked_ids:
+        capture_ids = rng.choice(1 << 24, nb_traces, replace=False)
+        labels = np.concatenate(
+            (
+                np.arange(1, nb_classes + 1),
+                rng.integers(1, nb_classes + 1, nb_traces - nb_classes),
+            )
+        )
+        save_dataset(
+            enforce_schema(
+                pd.DataFrame({"capture_id": capture_ids, "cell_id": labels})
+            ),
+            "verif",
+            attacked_id,
+        )
+        proba = rng.random((nb_traces, nb_classes))
+        attack = pd.DataFrame(
+            proba / proba.sum(axis=1, keepdims=True),
+            columns=["proba_class_{}".format(i) for i in range(1, nb_classes + 1)],
+        )
+        attack.insert(0, "capture_id", capture_ids)
+        attack.insert(0, "team_id", attacked_id)
+        attacks.append(attack)
+    df = pd.concat(attacks).sample(frac=1, random_state=seed)
+    return df[rng.permutation(df.columns)].reset_index(drop=True)
+
+
+@contextmanager
+def count_queries():
+    """Counts the SQL statements executed in the block, in the list yielded"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def fake_round(nb_teams: int, round: int = 1) -> list:
+    """Registers nb_teams teams, each attacking the next two ones in the round, with several defences and attacks for all of them but the last team"""
+    teams = [Team(team_name="team{}_{}".format(round, i)) for i in range(nb_teams)]
+    db.session.add_all(teams)
+    db.session.commit()
+    now = datetime.utcnow()
+    for i, team in enumerate(teams[:-1]):
+        for age in range(2):
+            db.session.add(
+                Defence(
+                    defender_team_id=team.id,
+                    round=round,
+                    timestamp=now - timedelta(minutes=age),
+                    utility=Utility(0, 0, -(10 + i + age), 0, 0, 20, 0, 0, 1.5),
+                )
+            )
+    for i, team in enumerate(teams):
+        for offset in [1, 2]:
+            match = Match(
+                attacker_team_id=team.id,
+                defender_team_id=teams[(i + offset) % nb_teams].id,
+                round=round,
+            )
+            db.session.add(match)
+            db.session.flush()
+            if i == nb_teams - 1:
+                continue
+            for age in range(2):
+                db.session.add(
+                    Attack(
+                        match_id=match.id,
+                        timestamp=now - timedelta(minutes=age),
+                        results=AttackResult(0.5, 0.5 + 0.1 * age + 0.01 * offset),
+                    )
+                )
+    db.session.commit()
+    return teams
+
+
+def history_scores(team, round: int) -> dict:
+    """Computes the scores of a team in the round from its defence and attack history, team by team"""
+    defence = team.latest_defence(round)
+    util_score = utility_score_of(
+        defence.utility.aggregated_score() if defence else None
+    )
+    results = [
+        attack.results.aggregated_result() for attack in team.latest_attacks(round)
+    ]
+    atk_perf = attack_performance_of(
+        sum(results) / len(results) if results else None,
+        len(results),
+        Match.nb_matches_in_round(round, team.id),
+    )
+    return {
+        "team_name": team.team_name,
+        "utility_score": util_score,
+        "attack_performance": atk_perf,
+        "score": total_score_of(util_score, atk_perf),
+    }
+
+
+class FakeRedis:
+    """In-memory stand-in for the few Redis commands of the leaderboard cache, with expiring keys"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        value, expiry = self.values.get(name, (None, None))
+        return None if expiry is not None and expiry < time.time() else value
+
+    def mget(self, *names):
+        return [self.get(name) for name in names]
+
+    def set(self, name, value, ex=None, nx=False):
+        if nx and self.get(name) is not None:
+            return None
+        expiry = time.time() + ex if ex is not None else None
+        self.values[name] = (str(value).encode(), expiry)
+        return True
+
+    def delete(self, name):
+        self.values.pop(name, None)
+
+    def incrby(self, name, amount=1):
+        value = int(self.get(name) or 0) + amount
+        self.set(name, value)
+        return value
+
+    def incr(self, name):
+        return self.incrby(name)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        # the scripts of the leaderboard cache, run atomically by Redis
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        if script == RELEASE_LOCK_SCRIPT:
+            if self.get(keys[0]) != str(args[0]).encode():
+                return 0
+            self.delete(keys[0])
+            return 1
+        if script == STORE_ITEMS_SCRIPT:
+            self.set(keys[0], args[0])
+            if self.incrby(keys[1], 0) != int(args[1]):
+                return 0
+            self.set(keys[2], 1, ex=int(args[2]))
+            return 1
+        raise NotImplementedError(script)
 
 
 class UserModelCase(unittest.TestCase):
@@ -106,6 +326,908 @@ class TeamModelCase(unittest.TestCase):
             self.assertEqual(m1.attacks.all(), [a1])
             self.assertEqual(t1.attacks().all(), [a2])
 
+            m3 = Match(defender_team_id=t1.id, attacker_team_id=t2.id, round=2)
+            db.session.add(m3)
+            db.session.commit()
+            pagination, matches_items = Match.paginate_and_itemize_match_query(
+                db.session.query(Match).order_by(Match.id), 1, 2, t1
+            )
+            self.assertEqual(pagination.total, 3)
+            self.assertEqual(matches_items, [m1, m2])
+            self.assertTrue(all(m.match_done for m in matches_items))
+            _, matches_items = Match.paginate_and_itemize_match_query(
+                db.session.query(Match).order_by(Match.id), 2, 2, t1
+            )
+            self.assertEqual(matches_items, [m3])
+            self.assertFalse(m3.match_done)
+
+    def test_duplicate_uploads(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        now = datetime.utcnow()
+        with app.app_context():
+            db.session.add_all([u1, u2])
+            db.session.commit()
+            t1 = Team(team_name="beepboop", member1_id=u1.id)
+            t2 = Team(team_name="diffie", member1_id=u2.id)
+            db.session.add_all([t1, t2])
+            db.session.commit()
+
+            d1 = Defence(defender_team_id=t1.id, round=1, digest="a", timestamp=now)
+            d2 = Defence(defender_team_id=t2.id, round=1, digest="b", timestamp=now)
+            m1 = Match(defender_team_id=t2.id, attacker_team_id=t1.id, round=1)
+            db.session.add_all([d1, d2, m1])
+            db.session.commit()
+            self.assertEqual(t1.duplicate_defence(1, "a"), d1)
+            self.assertIsNone(t1.duplicate_defence(1, "b"))
+            self.assertEqual(t1.duplicate_attacks(1, "x"), [])
+
+            a1 = Attack(match_id=m1.id, digest="x", timestamp=now + timedelta(1))
+            db.session.add(a1)
+            db.session.commit()
+            self.assertEqual(t1.duplicate_attacks(1, "x"), [a1])
+            self.assertEqual(t1.duplicate_attacks(1, "y"), [])
+
+            # the attacked team changed its defence, the attack must be evaluated again
+            d3 = Defence(
+                defender_team_id=t2.id,
+                round=1,
+                digest="c",
+                timestamp=now + timedelta(2),
+            )
+            db.session.add(d3)
+            db.session.commit()
+            self.assertEqual(t1.duplicate_attacks(1, "x"), [])
+
+    def test_metric_columns(self):
+        with app.app_context():
+            utility = Utility(
+                *np.array([-1e6, -5e5, -4e5, 2e4, 1e4, 9e3, 12.5, 8.0, 7.5])
+            )
+            utility.max_in_volume = np.int64(-1000000)
+            d = Defence(utility=utility)
+            a = Attack(results=AttackResult(np.float64(0.25), 0.75))
+            db.session.add_all([d, a])
+            db.session.commit()
+            self.assertEqual(d.utility.to_dict(), utility.to_dict())
+            self.assertEqual(d.aggregated_score, utility.aggregated_score())
+            self.assertEqual(
+                a.results.to_dict(), {"accuracy": 0.25, "roc_auc_score": 0.75}
+            )
+            # the metrics can be filtered on by the database
+            self.assertEqual(Defence.query.filter(Defence.med_time > 7).all(), [d])
+            self.assertEqual(
+                Attack.query.filter(Attack.aggregated_result > 7).all(), [a]
+            )
+            self.assertIsNone(Defence().utility)
+
+    def test_one_direction_utility(self):
+        df = fake_defence_dataframe()
+        # an upload without incoming packets has no utility score, it is rejected
+        df["direction_size"] = df["direction_size"].abs()
+        ok, error_msg = verify_dataframe(summarize_captures(df))
+        self.assertFalse(ok)
+        self.assertIn("incoming packets", error_msg)
+        df = fake_defence_dataframe().assign(timestamp=0.0)
+        ok, error_msg = verify_dataframe(summarize_captures(df))
+        self.assertFalse(ok)
+        self.assertIn("median duration", error_msg)
+        with app.app_context():
+            # the legacy defences of such uploads have NULL volumes and aggregated score
+            d = Defence(max_time=1.0, mean_time=0.5, med_time=0.5, med_out_volume=20.0)
+            db.session.add(d)
+            db.session.commit()
+            self.assertTrue(np.isnan(d.utility.med_in_volume))
+            self.assertEqual(d.utility.med_out_volume, 20.0)
+
+    def test_keyset_pagination(self):
+        with app.app_context():
+            fake_round(4, round=1)
+            fake_round(3, round=2)
+            ordered = Match.query.order_by(Match.round.desc(), Match.id.desc()).all()
+            pages, after = [], None
+            while True:
+                items, after, before = Match.keyset_paginate_and_itemize_match_query(
+                    db.session.query(Match), 4, after=after
+                )
+                self.assertEqual(before is None, not pages)
+                pages.append(items)
+                if after is None:
+                    break
+            self.assertEqual([m for page in pages for m in page], ordered)
+            self.assertEqual([len(page) for page in pages], [4, 4, 4, 2])
+            # the last match of round 2 is never attacked
+            self.assertEqual(
+                [m.match_done for m in pages[0]], [False, False, True, True]
+            )
+            # going back from the last page gives the same pages
+            while before is not None:
+                items, after, before = Match.keyset_paginate_and_itemize_match_query(
+                    db.session.query(Match), 4, before=before
+                )
+                self.assertIsNotNone(after)
+                pages.pop()
+                self.assertEqual(items, pages[-1])
+            self.assertEqual(len(pages), 1)
+
+    def test_leaderboard_items(self):
+        with app.app_context():
+            teams = fake_round(3)
+            # the scores are only stored on write
+            self.assertEqual(
+                Team.leaderboard_items(1)[0]["score"], NO_TOTAL_SCORE_MESSAGE
+            )
+            TeamRoundScore.refresh(1)
+            db.session.commit()
+            with count_queries() as statements:
+                team_items = Team.leaderboard_items(1)
+            nb_queries = len(statements)
+            self.assertEqual(
+                sorted(team_items, key=lambda item: item["team_name"]),
+                [history_scores(team, 1) for team in teams],
+            )
+            self.assertEqual(
+                [item["team_name"] for item in team_items],
+                [
+                    team.team_name
+                    for team in sorted(teams[:-1], key=lambda t: -t.total_score(1))
+                ]
+                + [teams[-1].team_name],
+            )
+            self.assertIsInstance(team_items[-1]["score"], str)
+            # the number of queries does not depend on the number of teams
+            fake_round(12, round=2)
+            TeamRoundScore.refresh(2)
+            db.session.commit()
+            with count_queries() as statements:
+                self.assertEqual(len(Team.leaderboard_items(2)), 15)
+            self.assertEqual(len(statements), nb_queries)
+
+            # a new attack only changes the scores of the attacking team once refreshed
+            match = teams[0].attack_matches.filter(Match.round == 1).first()
+            db.session.add(Attack(match_id=match.id, results=AttackResult(1.0, 1.0)))
+            TeamRoundScore.refresh(1, [teams[0].id])
+            db.session.commit()
+            for team in teams:
+                self.assertEqual(
+                    {
+                        "team_name": team.team_name,
+                        "utility_score": team.utility_score(1),
+                        "attack_performance": team.attack_performance(1),
+                        "score": team.total_score(1),
+                    },
+                    history_scores(team, 1),
+                )
+            self.assertEqual(teams[0].round_score(1).completed_matches, 2)
+
+
+class DefenceTasksCase(unittest.TestCase):
+    def test_streamed_summary(self):
+        df = fake_defence_dataframe()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "defence.csv.zip")
+            df.to_csv(filepath, index=False)
+            # chunks boundaries falling in the middle of captures must not change the summary
+            streamed = stream_capture_summary(filepath, chunksize=777)
+            df = read_csv(filepath)
+        pd.testing.assert_frame_equal(streamed, summarize_captures(df))
+        self.assertEqual(verify_dataframe(streamed), (True, ""))
+
+        grouped = df.groupby(["cell_id", "rep"])
+        in_volume = (
+            df[df["direction_size"] < 0]
+            .groupby(["cell_id", "rep"])["direction_size"]
+            .sum()
+        )
+        utility = evaluate_utility(streamed)
+        self.assertEqual(utility.med_in_volume, in_volume.median())
+        self.assertEqual(utility.max_time, grouped["timestamp"].max().max())
+
+        # one capture too short
+        self.assertFalse(verify_dataframe(summarize_captures(df.iloc[5:]))[0])
+        # one class missing
+        self.assertFalse(
+            verify_dataframe(summarize_captures(df[df["cell_id"] != 1]))[0]
+        )
+        # one very long capture would make huge padded feature matrices
+        long_capture = pd.DataFrame(
+            {
+                "cell_id": 1,
+                "rep": 0,
+                "direction_size": np.ones(app.config["MAX_FEATURE_CELLS"] // 1000),
+                "timestamp": 0.0,
+            }
+        )
+        ok, error_msg = verify_dataframe(
+            summarize_captures(pd.concat([df[df["rep"] != 0], long_capture]))
+        )
+        self.assertFalse(ok)
+        self.assertIn("longest trace", error_msg)
+
+    def test_randomize_rep_index(self):
+        df = fake_defence_dataframe(nb_rep=4)
+        new_rep = randomize_rep_index(df)
+        # the new labels are a bijection of the (cell_id, rep) pairs
+        pairs = df[["cell_id", "rep"]].assign(new_rep=new_rep).drop_duplicates()
+        self.assertEqual(len(pairs), pairs["new_rep"].nunique())
+        self.assertEqual(len(pairs), len(df[["cell_id", "rep"]].drop_duplicates()))
+
+    def test_split_train_test_set(self):
+        df = fake_defence_dataframe(nb_rows=10)
+        test_set, verification_set, train_set = split_train_test_set(df)
+        self.assertEqual(len(verification_set), app.config["NB_TRACES_TO_CLASSIFY"])
+        self.assertEqual(
+            verification_set["cell_id"].nunique(), app.config["NB_CLASSES"]
+        )
+        self.assertEqual(
+            set(test_set["capture_id"]), set(verification_set["capture_id"])
+        )
+        # every row lands in exactly one set, captures are not split between sets
+        self.assertEqual(len(test_set), 10 * len(verification_set))
+        self.assertEqual(
+            len(train_set[["cell_id", "rep"]].drop_duplicates()),
+            len(df[["cell_id", "rep"]].drop_duplicates()) - len(verification_set),
+        )
+        np.testing.assert_array_equal(
+            np.sort(np.concatenate([test_set["timestamp"], train_set["timestamp"]])),
+            np.sort(df["timestamp"]),
+        )
+
+    def test_feature_matrices(self):
+        df = fake_defence_dataframe(nb_rows=10)
+        test_set, verification_set, train_set = split_train_test_set(df)
+        # captures of different lengths are padded to the longest one
+        test_set = test_set.iloc[1:]
+        features = feature_matrices(test_set, train_set)
+        np.testing.assert_array_equal(
+            features["test_capture_ids"], verification_set["capture_id"]
+        )
+        self.assertEqual(features["test_direction_size"].shape[1], 10)
+        self.assertEqual(features["test_lengths"][0], 9)
+        for capture_id, row, length in zip(
+            features["test_capture_ids"][:5],
+            features["test_direction_size"],
+            features["test_lengths"],
+        ):
+            sizes = test_set.loc[
+                test_set["capture_id"] == capture_id, "direction_size"
+            ].to_numpy()
+            np.testing.assert_array_equal(row[:length], sizes)
+            self.assertFalse(row[length:].any())
+        captures = train_set[["cell_id", "rep"]].drop_duplicates()
+        np.testing.assert_array_equal(features["train_labels"], captures["cell_id"])
+        self.assertEqual(features["train_timestamp"].shape, (len(captures), 10))
+        self.assertTrue((features["train_lengths"] == 10).all())
+
+
+class DatasetsCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_folder = app.config["UPLOAD_FOLDER"]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        app.config["UPLOAD_FOLDER"] = self.tmp_dir.name
+
+    def tearDown(self):
+        app.config["UPLOAD_FOLDER"] = self.upload_folder
+        self.tmp_dir.cleanup()
+
+    def test_save_and_load(self):
+        # the sets produced by the server are typed with compact types
+        df = enforce_schema(fake_defence_dataframe(nb_rep=2, nb_rows=7))
+        self.assertEqual(df["cell_id"].dtype, np.int16)
+        self.assertEqual(df["timestamp"].dtype, np.float32)
+        save_dataset(df, "train", 3)
+        # the csv given to the students and the server side copy hold the same data
+        pd.testing.assert_frame_equal(
+            pd.read_csv(dataset_path("TRAIN_FILENAME_FORMAT", 3)), df, check_dtype=False
+        )
+        pd.testing.assert_frame_equal(load_dataset("train", 3), df)
+        pd.testing.assert_frame_equal(
+            load_dataset("train", 3, columns=["rep"]), df[["rep"]]
+        )
+        pd.testing.assert_frame_equal(
+            read_csv(dataset_path("TRAIN_FILENAME_FORMAT", 3)), df
+        )
+        # the files are written through temporary files, given the mode open would
+        self.assertIn(
+            app.config["TRAIN_FILENAME_FORMAT"].format(3), os.listdir(self.tmp_dir.name)
+        )
+        self.assertFalse(
+            [name for name in os.listdir(self.tmp_dir.name) if name.endswith(".tmp")]
+        )
+        for filename in os.listdir(self.tmp_dir.name):
+            mode = os.stat(os.path.join(self.tmp_dir.name, filename)).st_mode
+            self.assertEqual(mode & 0o777, 0o666 & ~UMASK)
+
+    def test_verification_cache(self):
+        save_dataset(
+            pd.DataFrame({"capture_id": [30, 10, 20], "cell_id": [3, 1, 2]}), "verif", 5
+        )
+        capture_ids, labels = load_verification_set(5)
+        np.testing.assert_array_equal(capture_ids, [10, 20, 30])
+        np.testing.assert_array_equal(labels, [1, 2, 3])
+        self.assertIs(load_verification_set(5)[0], capture_ids)
+        # a new defence replaces the file, the cached arrays must not be served anymore
+        save_dataset(pd.DataFrame({"capture_id": [7], "cell_id": [4]}), "verif", 5)
+        np.testing.assert_array_equal(load_verification_set(5)[1], [4])
+
+    def test_enforce_schema(self):
+        with self.assertRaises(ValueError):
+            enforce_schema(pd.DataFrame({"cell_id": [1.5, 2.0]}))
+        with self.assertRaises(ValueError):
+            enforce_schema(pd.DataFrame({"cell_id": [1, 40000]}))
+        with self.assertRaises(ValueError):
+            enforce_schema(pd.DataFrame({"timestamp": ["a", "b"]}))
+
+    def test_zip_members(self):
+        # a zip holding no file or several is rejected whichever parser reads it
+        path = os.path.join(self.tmp_dir.name, "upload.csv.zip")
+        for names in [[], ["a.csv", "b.csv"]]:
+            with ZipFile(path, "w") as zip:
+                zip.writestr("folder/", "")
+                for name in names:
+                    zip.writestr(name, "cell_id\n1\n")
+            with self.assertRaises(ValueError):
+                read_csv(path)
+            with self.assertRaises(ValueError):
+                read_csv_header(path)
+        # the directories of the archive are not files
+        with ZipFile(path, "w") as zip:
+            zip.writestr("folder/", "")
+            zip.writestr("folder/a.csv", "cell_id\n1\n")
+        self.assertEqual(read_csv(path)["cell_id"].tolist(), [1])
+        self.assertEqual(list(read_csv_header(path)), ["cell_id"])
+
+
+class MatchmakingCase(unittest.TestCase):
+    def setUp(self):
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_pair_teams(self):
+        rng = np.random.default_rng(0)
+        team_ids = np.arange(5, 25)
+        past_pairs = np.empty((0, 2), dtype=np.int64)
+        for _ in range(4):
+            pairs = pair_teams(team_ids, 3, past_pairs, 16, rng)
+            self.assertEqual(len(pairs), 60)
+            # every team attacks and is attacked 3 times, never by itself nor twice by the same team
+            self.assertTrue((np.bincount(pairs[:, 0])[team_ids] == 3).all())
+            self.assertTrue((np.bincount(pairs[:, 1])[team_ids] == 3).all())
+            self.assertFalse((pairs[:, 0] == pairs[:, 1]).any())
+            self.assertEqual(len(np.unique(pairs, axis=0)), 60)
+            # there are enough teams to never repeat a match
+            self.assertEqual(
+                len(np.unique(np.concatenate((past_pairs, pairs)), axis=0)),
+                len(past_pairs) + 60,
+            )
+            past_pairs = np.concatenate((past_pairs, pairs))
+        # the matches of the 20 teams are exhausted after 6 rounds, some are repeated
+        for _ in range(3):
+            pairs = pair_teams(team_ids, 3, past_pairs, 16, rng)
+            past_pairs = np.concatenate((past_pairs, pairs))
+        self.assertEqual(len(np.unique(past_pairs, axis=0)), 20 * 19)
+        self.assertEqual(len(pair_teams(np.array([1]), 1, past_pairs, 4, rng)), 0)
+
+    def test_generate_round_matches(self):
+        with app.app_context():
+            admin = User(username="admin", is_admin=True)
+            db.session.add(admin)
+            db.session.commit()
+            teams = [Team(team_name="team{}".format(i)) for i in range(6)]
+            teams[0].member2_id = admin.id
+            db.session.add_all(teams)
+            db.session.commit()
+            with count_queries() as statements:
+                nb_matches = generate_round_matches(1, np.random.default_rng(0))
+            self.assertEqual(len(statements), 3)
+            self.assertEqual(nb_matches, 15)
+            matches = Match.query.filter(Match.round == 1).all()
+            self.assertEqual(len(matches), 15)
+            self.assertNotIn(
+                teams[0].id,
+                {m.attacker_team_id for m in matches}
+                | {m.defender_team_id for m in matches},
+            )
+
+
+class MetricsCase(unittest.TestCase):
+    def test_one_vs_rest_roc_auc(self):
+        rng = np.random.default_rng(0)
+        for nb_classes, nb_captures, decimals in [
+            (3, 50, 1),
+            (10, 300, 2),
+            (100, 300, 8),
+        ]:
+            classes = np.arange(1, nb_classes + 1)
+            labels = np.concatenate(
+                (classes, rng.integers(1, nb_classes + 1, nb_captures - nb_classes))
+            )
+            # rounding gives many tied probabilities
+            proba = np.round(rng.random((nb_captures, nb_classes)), decimals)
+            proba /= proba.sum(axis=1, keepdims=True)
+            self.assertAlmostEqual(
+                one_vs_rest_roc_auc(labels, proba, classes),
+                roc_auc_score(labels, proba, multi_class="ovr", labels=classes),
+                places=9,
+            )
+        # a perfect classification
+        self.assertEqual(
+            one_vs_rest_roc_auc(labels, np.eye(100)[labels - 1], classes), 1.0
+        )
+        with self.assertRaises(ValueError):
+            one_vs_rest_roc_auc(labels, proba, np.arange(2, 102))
+
+
+class AttackTasksCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_folder = app.config["UPLOAD_FOLDER"]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        app.config["UPLOAD_FOLDER"] = self.tmp_dir.name
+        with app.app_context():
+            app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+            db.create_all()
+
+    def tearDown(self):
+        app.config["UPLOAD_FOLDER"] = self.upload_folder
+        self.tmp_dir.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_evaluate_attack_perf(self):
+        with app.app_context():
+            teams = [Team(team_name="team{}".format(i)) for i in range(3)]
+            db.session.add_all(teams)
+            db.session.commit()
+            matches = [
+                Match(
+                    defender_team_id=defender.id,
+                    attacker_team_id=teams[0].id,
+                    round=app.config["ROUND"],
+                )
+                for defender in teams[1:]
+            ]
+            db.session.add_all(matches)
+            db.session.commit()
+
+            df = enforce_schema(fake_attack_dataframe([t.id for t in teams[1:]]))
+            self.assertEqual(verify_attack(df, teams[0]), (True, ""))
+            attacks = evaluate_attack_perf(df, teams[0])
+            self.assertEqual(
+                sorted(a.match_id for a in attacks), sorted(m.id for m in matches)
+            )
+            columns = [
+                "proba_class_{}".format(i)
+                for i in range(1, app.config["NB_CLASSES"] + 1)
+            ]
+            for attack in attacks:
+                # the reference scores are computed team by team on the rows in verification order
+                attacked_id = db.session.get(Match, attack.match_id).defender_team_id
+                capture_ids, labels = load_verification_set(attacked_id)
+                proba = (
+                    df[df["team_id"] == attacked_id]
+                    .set_index("capture_id")
+                    .loc[capture_ids, columns]
+                    .to_numpy()
+                )
+                self.assertAlmostEqual(
+                    attack.results.accuracy,
+                    np.mean(proba.argmax(axis=1) + 1 == labels),
+                )
+                self.assertAlmostEqual(
+                    attack.results.roc_auc_score,
+                    roc_auc_score(labels, proba, multi_class="ovr"),
+                )
+
+    def test_answer_key(self):
+        with app.app_context():
+            teams = [Team(team_name="team{}".format(i)) for i in range(3)]
+            db.session.add_all(teams)
+            db.session.commit()
+            m1 = Match(
+                defender_team_id=teams[2].id, attacker_team_id=teams[0].id, round=2
+            )
+            m2 = Match(
+                defender_team_id=teams[1].id, attacker_team_id=teams[0].id, round=2
+            )
+            m3 = Match(
+                defender_team_id=teams[0].id, attacker_team_id=teams[1].id, round=2
+            )
+            db.session.add_all([m1, m2, m3])
+            db.session.commit()
+            fake_attack_dataframe([teams[1].id])
+
+            # the key is built by the first load, then read from its file and cached
+            load_answer_key(2)
+            answer_key = load_answer_key(2)
+            self.assertIs(load_answer_key(2), answer_key)
+            target_ids, match_ids = answer_key.targets(teams[0].id)
+            np.testing.assert_array_equal(target_ids, [teams[1].id, teams[2].id])
+            np.testing.assert_array_equal(match_ids, [m2.id, m1.id])
+            self.assertEqual(len(answer_key.targets(teams[2].id)[0]), 0)
+            capture_ids, labels = answer_key.verification_set(teams[1].id)
+            np.testing.assert_array_equal(
+                capture_ids, load_verification_set(teams[1].id)[0]
+            )
+            np.testing.assert_array_equal(labels, load_verification_set(teams[1].id)[1])
+            # the teams without defence have an empty verification set until they defend
+            self.assertEqual(len(answer_key.verification_set(teams[0].id)[0]), 0)
+            fake_attack_dataframe([teams[0].id])
+            self.assertEqual(
+                len(load_answer_key(2).verification_set(teams[0].id)[0]),
+                app.config["NB_TRACES_TO_CLASSIFY"],
+            )
+
+    def test_verify_attack(self):
+        with app.app_context():
+            teams = [Team(team_name="team{}".format(i)) for i in range(3)]
+            db.session.add_all(teams)
+            db.session.commit()
+            db.session.add_all(
+                [
+                    Match(
+                        defender_team_id=defender.id,
+                        attacker_team_id=teams[0].id,
+                        round=app.config["ROUND"],
+                    )
+                    for defender in teams[1:]
+                ]
+            )
+            db.session.commit()
+            df = enforce_schema(fake_attack_dataframe([t.id for t in teams[1:]]))
+
+            wrong_team = df.copy()
+            wrong_team.loc[0, "team_id"] = teams[0].id
+            self.assertFalse(verify_attack(wrong_team, teams[0])[0])
+
+            wrong_captures = df.copy()
+            wrong_captures.loc[:9, "capture_id"] = -1
+            verified, error_msg = verify_attack(wrong_captures, teams[0])
+            self.assertFalse(verified)
+            self.assertIn("invalid capture_id", error_msg)
+
+            wrong_proba = df.copy()
+            wrong_proba.loc[:, "proba_class_1"] += 0.01
+            wrong_proba.loc[0, "proba_class_2"] = np.nan
+            verified, error_msg = verify_attack(wrong_proba, teams[0])
+            self.assertFalse(verified)
+            self.assertIn("{:d} rows".format(len(df)), error_msg)
+            # the error message only cites the first faulty rows
+            self.assertLess(len(error_msg), 300)
+
+
+class BundlesCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_folder = app.config["UPLOAD_FOLDER"]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        app.config["UPLOAD_FOLDER"] = self.tmp_dir.name
+        app.config["WTF_CSRF_ENABLED"] = False
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        app.config["UPLOAD_FOLDER"] = self.upload_folder
+        app.config["WTF_CSRF_ENABLED"] = True
+        self.tmp_dir.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def save_sets(self, team_id: int, seed: int = 0):
+        df = fake_defence_dataframe(nb_rep=2, nb_rows=2, seed=seed)
+        save_dataset(df, "test", team_id)
+        save_dataset(df, "train", team_id)
+
+    def test_build_bundles(self):
+        with app.app_context():
+            teams = fake_round(4)
+            for team in teams[:3]:
+                self.save_sets(team.id)
+            # the team 2 attacks the team 3, which has not defended yet
+            self.assertEqual(build_round_bundles(1), 2)
+            with self.assertRaises(FileNotFoundError):
+                build_bundle(teams[2].id, 1)
+            self.assertIsNone(build_bundle(teams[0].id, 2))
+            path = build_bundle(teams[0].id, 1)
+            with ZipFile(path) as zip:
+                self.assertEqual(
+                    zip.namelist(),
+                    [
+                        "team_{}_{}.csv.zip".format(team.id, kind)
+                        for kind in ["test", "train"]
+                        for team in teams[1:3]
+                    ],
+                )
+            # the bundles are only built once per version of their sets
+            mtime = os.stat(path).st_mtime_ns
+            self.assertEqual(build_round_bundles(1), 2)
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+            self.save_sets(teams[1].id, seed=1)
+            # the teams 0 and 3 attack the team 1
+            self.assertEqual(build_round_bundles(1, teams[1].id), 2)
+            new_path = build_bundle(teams[0].id, 1)
+            self.assertNotEqual(new_path, path)
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(
+                [name for name in os.listdir(self.tmp_dir.name) if "tmp" in name]
+            )
+            # a version written by a builder that started later is kept, a version removed meanwhile by another builder is skipped
+            self.save_sets(teams[1].id, seed=2)
+            newer_path = bundle_path(teams[0].id, 1, "f" * 16)
+            open(newer_path, "wb").close()
+            os.utime(newer_path, ns=(time.time_ns() + 10**10,) * 2)
+            removed_path = bundle_path(teams[0].id, 1, "0" * 16)
+            with unittest.mock.patch(
+                "glob.glob", return_value=[removed_path, new_path, newer_path]
+            ):
+                latest_path = build_bundle(teams[0].id, 1)
+            self.assertTrue(os.path.exists(latest_path))
+            self.assertFalse(os.path.exists(new_path))
+            self.assertTrue(os.path.exists(newer_path))
+
+    def test_download_bundle(self):
+        with app.app_context():
+            user = User(username="john", email="john@example.com")
+            user.set_password("hoho")
+            db.session.add(user)
+            db.session.commit()
+            teams = fake_round(3)
+            teams[0].member1_id = user.id
+            db.session.commit()
+            for team in teams:
+                self.save_sets(team.id)
+        client = app.test_client()
+        client.post("/login", data={"username": "john", "password": "hoho"})
+        temp_files = os.listdir(tempfile.gettempdir())
+        # the bundle is streamed until it is built, then sent from its file, with the same bytes
+        downloads = []
+        for built in [False, True]:
+            if built:
+                with app.app_context():
+                    build_round_bundles(1)
+            response = client.get("/attack/?download=1")
+            self.assertEqual(response.status_code, 200)
+            downloads.append((response.get_data(), response.get_etag()))
+            response.close()
+        self.assertEqual(downloads[0], downloads[1])
+        content, (etag, weak) = downloads[0]
+        self.assertFalse(weak)
+        with ZipFile(BytesIO(content)) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(len(zip.namelist()), 4)
+        with app.app_context():
+            os.remove(build_bundle(teams[0].id, 1))
+        for built in [False, True]:
+            if built:
+                with app.app_context():
+                    build_round_bundles(1)
+            response = client.get(
+                "/attack/?download=1", headers={"If-None-Match": '"{}"'.format(etag)}
+            )
+            self.assertEqual(response.status_code, 304)
+            response.close()
+            response = client.get(
+                "/attack/?download=1", headers={"Range": "bytes=100-"}
+            )
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.get_data(), content[100:])
+            response.close()
+            # an outdated If-Range gets the whole archive
+            response = client.get(
+                "/attack/?download=1",
+                headers={"Range": "bytes=100-199", "If-Range": '"outdated"'},
+            )
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            # so does an If-Range holding a date
+            response = client.get(
+                "/attack/?download=1",
+                headers={
+                    "Range": "bytes=100-199",
+                    "If-Range": "Wed, 21 Oct 2015 07:28:00 GMT",
+                },
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), content)
+            response.close()
+            response = client.get(
+                "/attack/?download=1",
+                headers={"Range": "bytes={}-".format(len(content))},
+            )
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(
+                response.headers["Content-Range"], "bytes */{}".format(len(content))
+            )
+            response.close()
+            with app.app_context():
+                os.remove(build_bundle(teams[0].id, 1))
+        self.assertEqual(os.listdir(tempfile.gettempdir()), temp_files)
+
+    def test_delta_download(self):
+        with app.app_context():
+            user = User(username="john", email="john@example.com")
+            user.set_password("hoho")
+            db.session.add(user)
+            db.session.commit()
+            teams = fake_round(3)
+            teams[0].member1_id = user.id
+            db.session.commit()
+            for team in teams:
+                self.save_sets(team.id)
+        client = app.test_client()
+        client.post("/login", data={"username": "john", "password": "hoho"})
+        manifest = client.get("/attack/manifest").get_json()
+        self.assertEqual(len(manifest["files"]), 4)
+        response = client.get(
+            "/attack/manifest",
+            headers={"If-None-Match": '"{}"'.format(manifest["version"])},
+        )
+        self.assertEqual(response.status_code, 304)
+        # the team 1 uploads a new defence, only its train set differs
+        save_dataset(
+            fake_defence_dataframe(nb_rep=2, nb_rows=2, seed=1), "train", teams[1].id
+        )
+        new_manifest = client.get("/attack/manifest").get_json()
+        self.assertNotEqual(new_manifest["version"], manifest["version"])
+        for since, names in [
+            (manifest["version"], ["team_{}_train.csv.zip".format(teams[1].id)]),
+            (new_manifest["version"], []),
+            ("0" * 16, [file["name"] for file in new_manifest["files"]]),
+        ]:
+            response = client.get("/attack/?download=1&since={}".format(since))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.headers["X-Bundle-Version"], new_manifest["version"]
+            )
+            with ZipFile(BytesIO(response.get_data())) as zip:
+                self.assertEqual(zip.namelist(), names)
+            response.close()
+
+
+class CachedLeaderboardCase(unittest.TestCase):
+    def setUp(self):
+        self.computations = 0
+
+    def tearDown(self):
+        CachedLeaderboard.redis_client = None
+        CachedLeaderboard.leaderboard = None
+
+    def compute(self):
+        self.computations += 1
+        return [{"team_name": "team", "score": str(self.computations)}]
+
+    def test_shared_leaderboard(self):
+        CachedLeaderboard.redis_client = FakeRedis()
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "1")
+        # the fresh items are served to every process without computation
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "1")
+        self.assertEqual(self.computations, 1)
+        CachedLeaderboard.invalidate(1)
+        # while another process holds the lock, the stale items are served
+        CachedLeaderboard.redis_client.set(
+            CachedLeaderboard.key(1, "lock"), "other", nx=True
+        )
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "1")
+        self.assertEqual(self.computations, 1)
+        CachedLeaderboard.redis_client.delete(CachedLeaderboard.key(1, "lock"))
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "2")
+        # the lock is released once the items are stored
+        self.assertIsNone(
+            CachedLeaderboard.redis_client.get(CachedLeaderboard.key(1, "lock"))
+        )
+
+    def test_invalidation_during_computation(self):
+        CachedLeaderboard.redis_client = FakeRedis()
+
+        def compute():
+            # new scores are committed while the leaderboard is computed
+            CachedLeaderboard.invalidate(1)
+            return self.compute()
+
+        self.assertEqual(CachedLeaderboard.get(1, compute)[0]["score"], "1")
+        # the items computed before the invalidation are not marked fresh
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "2")
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "2")
+
+    def test_waiting_for_first_items(self):
+        CachedLeaderboard.redis_client = FakeRedis()
+        CachedLeaderboard.redis_client.set(
+            CachedLeaderboard.key(1, "lock"), "other", nx=True
+        )
+        with unittest.mock.patch("app.cached_items.LEADERBOARD_WAIT_TIME", 0.1):
+            self.assertIsNone(CachedLeaderboard.get(1, self.compute))
+        # the waiting process neither computed the items nor released the lock of the other one
+        self.assertEqual(self.computations, 0)
+        self.assertEqual(
+            CachedLeaderboard.redis_client.get(CachedLeaderboard.key(1, "lock")),
+            b"other",
+        )
+
+    def test_unreachable_redis(self):
+        CachedLeaderboard.redis_client = redis.Redis(port=1, socket_connect_timeout=0.1)
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "1")
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "1")
+        CachedLeaderboard.invalidate(1)
+        self.assertEqual(CachedLeaderboard.get(1, self.compute)[0]["score"], "2")
+
+
+class QueryBudgetCase(unittest.TestCase):
+    """Number of SQL queries of the pages, which must not grow with the number of teams"""
+
+    def setUp(self):
+        app.config["WTF_CSRF_ENABLED"] = False
+        app.config["QUERY_STATS_HEADERS"] = True
+        CachedLeaderboard.redis_client = FakeRedis()
+        with app.app_context():
+            db.create_all()
+            user = User(username="john", email="john@example.com")
+            user.set_password("hoho")
+            db.session.add(user)
+            db.session.commit()
+        self.client = app.test_client()
+        self.client.post("/login", data={"username": "john", "password": "hoho"})
+
+    def tearDown(self):
+        app.config["WTF_CSRF_ENABLED"] = True
+        app.config["QUERY_STATS_HEADERS"] = False
+        CachedLeaderboard.redis_client = None
+        CachedLeaderboard.leaderboard = None
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def query_count(self, url: str) -> int:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("X-Query-Time", response.headers)
+        return int(response.headers["X-Query-Count"])
+
+    def test_query_budget(self):
+        # the requests of a logged in user load it and its team, with one query
+        budgets = {
+            "/": 2,
+            "/?after=2_1000": 2,
+            "/leaderboard/": 2,
+            "/user/john": 2,
+            "/team/{}": 7,
+        }
+        round = app.config["ROUND"]
+        for nb_teams in [3, 12]:
+            with app.app_context():
+                fake_round(nb_teams, round=nb_teams)
+                TeamRoundScore.refresh(nb_teams)
+                db.session.commit()
+            app.config["ROUND"] = nb_teams
+            for url, budget in budgets.items():
+                url = url.format("team{}_0".format(nb_teams))
+                self.assertEqual(self.query_count(url), budget)
+        app.config["ROUND"] = round
+
+    def test_identity_cache(self):
+        with app.app_context():
+            db.session.add(Team(team_name="beepboop", member1_id=1))
+            db.session.commit()
+        app.config["IDENTITY_CACHE_TIME"] = 60
+        try:
+            self.assertEqual(self.query_count("/user/john"), 2)
+            # the user and its team are not loaded again
+            self.assertEqual(self.query_count("/user/john"), 1)
+            self.assertEqual(self.query_count("/team/beepboop"), 6)
+        finally:
+            app.config["IDENTITY_CACHE_TIME"] = 0
+            cached_identities.clear()
+
+    def test_over_budget_warning(self):
+        with unittest.mock.patch("app.query_stats.QUERY_BUDGET", 0):
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                self.query_count("/user/john")
+        self.assertIn("GET /user/john", logs.output[0])
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)